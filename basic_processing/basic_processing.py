@@ -1,101 +1,41 @@
 # Basic filtering to get rid of easy-to-identify irrelevantabstracts.
 
-from functools import partial
-import re
+import os
 import sys
+import time
 
-from num2words import num2words
+import numpy
 import pandas
-from unidecode import unidecode
 
-
-def excel_sheet_name(s):
-    if len(s) > 31:
-        return s[:31]
-    else:
-        return s
-
-
-def match_phrases(df, colname, phrases, excelwriter=None, sheet_name=None):
-    result = None
-    for phrase in phrases:
-        matches = df[colname].str.lower().str.contains(phrase, regex=True)
-        if result is None:
-            result = matches
-        else:
-            result |= matches
-    if excelwriter is not None:
-        df[result].to_excel(excelwriter, sheet_name=excel_sheet_name(sheet_name))
-
-    return result
-
-
-def remove_publication_type(df, t, excelwriter=None, result_series=None):
-    result = match_phrases(df, "publication types", [t], excelwriter, t)
-    print(f"Removed {result.sum()} {t}; was {len(df)} is now {len(df) - result.sum()}")
-    if result_series is not None:
-        result_series.append(result.sum())
-    return df[~result]
-
-
-def remove_title_phrases(df, title_phrases, name, excelwriter=None, result_series=None):
-    result = match_phrases(df, "title", title_phrases, excelwriter, name)
-    print(
-        f"Removed {result.sum()} {name}; was {len(df)} is now {len(df) - result.sum()}"
-    )
-    if result_series is not None:
-        result_series.append(result.sum())
-    return df[~result]
-
-
-def remove_journal_phrases(df, phrases, name, excelwriter=None, result_series=None):
-    result = match_phrases(df, "journal", phrases, excelwriter, name)
-    print(
-        f"Removed {result.sum()} {name}; was {len(df)} is now {len(df) - result.sum()}"
-    )
-    if result_series is not None:
-        result_series.append(result.sum())
-    return df[~result]
-
-
-def remove_title_publication_type(
-    df,
-    title_phrases,
-    pub_types,
-    name,
-    journal_phrase=None,
-    excelwriter=None,
-    result_series=None,
-):
-    result = match_phrases(
-        df,
-        "publication types",
-        pub_types,
-        excelwriter,
-        sheet_name=excel_sheet_name(f"{name}-pub-types"),
-    )
-    print(f"pub_types: {result.sum()}")
-    title_result = match_phrases(df, "title", title_phrases)
-    if excelwriter is not None:
-        df[title_result & ~result].to_excel(
-            excelwriter, sheet_name=excel_sheet_name(f"{name}-title")
-        )
-    result |= title_result
-    print(f"title: {title_result.sum()}")
-    if journal_phrase is not None:
-        journal_result = match_phrases(df, "journal", [journal_phrase])
-        if excelwriter is not None:
-            df[journal_result & ~result].to_excel(
-                excelwriter, sheet_name=excel_sheet_name(f"{name}-journal")
-            )
-        result |= journal_result
-        print(f"journal: {journal_result.sum()}")
-    print(
-        f"Removed {result.sum()} {name}; was {len(df)} is now {len(df) - result.sum()}"
-    )
-    if result_series is not None:
-        result_series.append(result.sum())
-    return df[~result]
+from dedup_keys import KeyIndex, hash_keys, key_values
+import intermediate
+import profiling
+import record_store
+from normalise import normalise, print_timings
+from overlap import prefetch
+from exclusion_audit import ExclusionWorkbook
+from profiling import Profiler
+from rule_engine import (
+    CompiledRules,
+    load_rules,
+    print_rule_counts,
+    profile_rules,
+    rule_counts,
+    sheet_codes,
+)
+
+
+# Exclusion rules, applied in order after deduplication. Each record is
+# excluded by (and counted against) the first rule it matches. They are read,
+# checked and compiled once per process, when this module is imported, and
+# shared by every source it processes.
+EXCLUSION_RULES_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "exclusion_rules.json"
+)
+EXCLUSION_RULES = load_rules(EXCLUSION_RULES_PATH)
+COMPILED_RULES = CompiledRules(EXCLUSION_RULES)
+# What became of a record, by the index of the rule that excluded it.
+RULE_DECISIONS = numpy.array([r.name for r in EXCLUSION_RULES] + ["kept"], dtype=object)
 
 
 def tidy_doi(s):
@@ -110,416 +50,357 @@ def tidy_doi(s):
     return s
 
 
-def tidy_title(s):
-    s = re.sub(r"\s+", " ", s)
-    s = s.lower().strip()
-    s = unidecode(s)
-    if s[0] == '"':
-        s = s[1:]
-    if s[-1] == '"':
-        s = s[:-1]
-    if s[-1] == ".":
-        s = s[:-1]
-    return s
-
+# Placeholder that some databases export instead of an abstract.
+NO_ABSTRACT = "No abstract available"
 
-def remove_line_breaks(s):
-    if pandas.isna(s):
-        return s
-    return re.sub(r"(?:\r\n|\r|\n)+", ";", s)
 
+def single_sentence(s):
+    # Whether s has exactly one full stop. Only the first two are looked for,
+    # which most abstracts have within a sentence or two.
+    i = s.find(".")
+    return i >= 0 and s.find(".", i + 1) < 0
 
-def tidy_authors(s, sep=";"):
-    if pandas.isna(s):
-        return s
-    s = remove_line_breaks(s)
-    s = unidecode(s)
-    authors = s.split(sep)
-    result = []
-    for name in authors:
-        name = name.strip()
-        if len(name) == 0:
-            continue
-        # Add a comma in the last space.
-        p = name.rfind(" ")
-        if name[p - 1] == ",":
-            # Don't insert another comma
-            result.append(name)
-        else:
-            # No comma, insert one.
-            result.append(name[:p] + "," + name[p:])
-    return ";".join(result)
-
-
-def first_author_surname(s):
-    # Assumes tidy_authors had been run first.
-    if pandas.isna(s):
-        return s
-    author = s.split(";")[0]
-    names = author.split(",")
-    if len(names) > 0:
-        return names[0]
-    return author
 
+def abstract_flags(abstracts):
+    # Whether each abstract is the placeholder and whether it is a single
+    # sentence, scanning each abstract with str methods rather than splitting
+    # it.
+    values = abstracts.tolist()
+    placeholder = numpy.fromiter((NO_ABSTRACT in a for a in values), dtype=bool, count=len(values))
+    single = numpy.fromiter(map(single_sentence, values), dtype=bool, count=len(values))
+    return placeholder, single
 
-def make_dedup_index(row):
-    s = f'{row["title"].strip()};{row["year"]:.0f};{row["first_author_surname"]}'.lower()
-    return re.sub(r"\s+", "", s)
 
+def english(languages):
+    # Whether each language is English (or missing), checking each distinct
+    # value once and mapping the results back through the codes.
+    if isinstance(languages.dtype, pandas.CategoricalDtype):
+        codes, uniques = languages.cat.codes.to_numpy(), languages.cat.categories
+    else:
+        codes, uniques = pandas.factorize(languages)
+    values = pandas.Series(uniques, dtype=object)
+    found = values.str.contains("eng", regex=False, na=False) | values.str.contains(
+        "English", regex=False, na=False
+    )
+    # Missing values have code -1, so take the result for them from the end.
+    return numpy.append(found.to_numpy(dtype=bool), True)[codes]
 
-def process(name, path):
-    print(f"\n\nProcessing {name}")
-    df = pandas.read_csv(path)
-    if "Unnamed: 0" in df.columns:
-        df = df.drop(columns="Unnamed: 0")
-    print(f"Found {len(df)} records")
-
-    pre_2014 = df["year"] < 2014
-    df = df[~pre_2014]
-    print(f"Removed {pre_2014.sum()} entries published before 2014")
 
-    result_series = [len(df)]
+def prefilter(df):
+    # Applies the filters that only look at one record at a time. Returns the
+    # remaining records, the number removed by each filter and the languages
+    # of the non-English records. The filters' masks are computed together
+    # and the records selected once; each record is counted against the first
+    # filter that removes it, in the order of the summary.
+    year = df["year"]
+    pre_2014 = (year < 2014).to_numpy()
 
     # Exclude anything without a title, abstract, or journal name
     no_abstract_or_title = (
-        df["abstract"].isna()
-        | df["title"].isna()
-        | df["journal"].isna()
-        | df["year"].isna()
+        df["abstract"].isna() | df["title"].isna() | df["journal"].isna() | year.isna()
+    ).to_numpy() & ~pre_2014
+    # Only the abstracts of the records still in are scanned.
+    scanned = numpy.flatnonzero(~(pre_2014 | no_abstract_or_title))
+    placeholder, single = abstract_flags(df["abstract"].iloc[scanned])
+    no_abstract_or_title[scanned[placeholder]] = True
+    abstract_single_sentence = numpy.zeros(len(df), dtype=bool)
+    abstract_single_sentence[scanned[single & ~placeholder]] = True
+
+    removed = pre_2014 | no_abstract_or_title | abstract_single_sentence
+    counts = [pre_2014.sum(), no_abstract_or_title.sum(), abstract_single_sentence.sum()]
+    languages = None
+    if "language" in df.columns:
+        non_eng = ~english(df["language"]) & ~removed
+        # As objects, so that only the languages found are counted.
+        languages = df.loc[non_eng, "language"].astype(object).value_counts()
+        removed |= non_eng
+        counts.append(non_eng.sum())
+    return df[~removed].copy(), counts, languages
+
+
+def record_keys(df):
+    # The identifiers of each record as exported, with what became of it, so
+    # that a later export's new records can be told apart (see delta.py).
+    # Records removed by prefilter() have no dedup_index.
+    return pandas.DataFrame(
+        {
+            "pmid": df["pmid"].map(intermediate.tidy_string),
+            "doi": df["doi"].apply(tidy_doi).map(intermediate.tidy_string),
+            "dedup_index": None,
+            "decision": "prefilter",
+        },
+        index=df.index,
     )
-    no_abstract_or_title |= df["abstract"].str.contains("No abstract available")
-    df = df[~no_abstract_or_title]
+
+
+def tidy_processed(df, name):
+    df = df.rename(columns={"country": "publish_country"})
+    df["doi"] = df["doi"].apply(tidy_doi)
+    df["source"] = name
+    return df
+
+
+def tidy_strings(values):
+    # values.map(intermediate.tidy_string), with columns of strings or of
+    # whole numbers converted at once.
+    if pandas.api.types.infer_dtype(values, skipna=True) == "string":
+        return values
+    if pandas.api.types.is_numeric_dtype(values) and not pandas.api.types.is_bool_dtype(values):
+        present = values.dropna()
+        if (present % 1 == 0).all():
+            return present.astype("int64").astype(str).reindex(values.index)
+    return values.map(intermediate.tidy_string)
+
+
+def row_hashes(df):
+    # Hashes of the records' values, treating the forms a value may take
+    # when read back in chunks (e.g. 1.0, 1 and "1") as the same.
+    values, _ = key_values(pandas.concat([tidy_strings(df[c]) for c in df.columns], axis=1))
+    return hash_keys(values)
+
+
+class DuplicateFilter:
+    # Drops records whose title, year and first author surname were already
+    # seen, in this chunk or an earlier one, keeping the first. The removed
+    # records are kept for the duplicates sheet, which lists those that are
+    # not identical in every column to another record, as comparing the
+    # whole source before and after deduplication did.
+    def __init__(self):
+        self.keys = KeyIndex()
+        self.kept_hashes = []
+        self.removed = []
+        self.removed_hashes = []
+
+    def drop_seen(self, df):
+        keys = df[["title", "year", "first_author_surname"]]
+        rows = row_hashes(df)
+        duplicate = self.keys.seen(keys)
+        self.keys.add(keys[~duplicate])
+        self.kept_hashes.append(rows[~duplicate])
+        self.removed.append(df[duplicate])
+        self.removed_hashes.append(rows[duplicate])
+        return df[~duplicate]
+
+    def count(self):
+        return sum(len(r) for r in self.removed)
+
+    def duplicates(self):
+        removed = pandas.concat(self.removed)
+        hashes = pandas.Series(numpy.concatenate(self.removed_hashes))
+        same = hashes.map(hashes.value_counts()).to_numpy()
+        same += numpy.isin(hashes, numpy.concatenate(self.kept_hashes))
+        return removed[same == 1]
+
+
+def process(name, path, chunk_size=None):
+    # With chunk_size, the source is read and processed that many records at
+    # a time, so memory is bounded by the chunk size rather than the source.
+    # Results are the same either way.
+    print(f"\n\nProcessing {name}")
+    profiler = Profiler(name)
+    start = time.perf_counter()
+    # Timing each rule on its own re-matches every rule, so is opt-in.
+    singles = None
+    if os.environ.get("PROFILE_RULES") == "1":
+        singles = [CompiledRules([r]) for r in EXCLUSION_RULES]
+    if chunk_size is None and os.environ.get("PROCESS_CHUNK_SIZE"):
+        chunk_size = int(os.environ["PROCESS_CHUNK_SIZE"])
+    sep = "," if name == "pubmed" else ";"
+    found = 0
+    prefilter_counts = None
+    languages = pandas.Series(dtype=int)
+    timings = {}
+    duplicate_filter = DuplicateFilter()
+    rule_totals = None
+    deduplicated = 0
+    remaining = 0
+    decisions = []
+
+    # Excluded records are tagged with their sheet as they are filtered and
+    # streamed to the workbook, optionally from a background thread.
+    audit = ExclusionWorkbook(
+        exclusions_path(name),
+        ["duplicates"] + COMPILED_RULES.sheet_names,
+        background=os.environ.get("EXCLUSIONS_BACKGROUND") == "1",
+    )
+    # Records and decisions are also written to the record store, if there
+    # is one, a chunk at a time.
+    store = record_store.open_store()
+
+    def processed_chunks():
+        nonlocal found, prefilter_counts, languages, rule_totals, deduplicated, remaining
+        # The next chunk is read while this one is filtered.
+        frames = prefetch(intermediate.iter_frames(path, chunk_size))
+        while True:
+            with profiler.stage("read") as stage:
+                df = next(frames, None)
+                stage["rows_out"] = 0 if df is None else len(df)
+            if df is None:
+                break
+            first = prefilter_counts is None
+            found += len(df)
+            parsed = df
+            keys = record_keys(df)
+            decisions.append(keys)
+            with profiler.stage("prefilter", len(df)) as stage:
+                df, counts, chunk_languages = prefilter(df)
+                stage["rows_out"] = len(df)
+            prefilter_counts = counts if prefilter_counts is None else [
+                a + b for a, b in zip(prefilter_counts, counts)
+            ]
+            if chunk_languages is not None:
+                languages = languages.add(chunk_languages, fill_value=0)
+
+            # Remove surrounding quotes and full stops from titles, newlines
+            # in authors and abstracts, and build the dedup index.
+            with profiler.stage("normalise", len(df)) as stage:
+                steps = normalise(df, sep)
+                stage["rows_out"] = len(df)
+            for step, t in steps.items():
+                timings[step] = timings.get(step, 0) + t
+                profiler.add(f"normalise: {step}", t, len(df), len(df))
+            keys.loc[df.index, "dedup_index"] = df["dedup_index"]
+            keys.loc[df.index, "decision"] = "duplicate"
+
+            if first:
+                audit.write_header(df, ["duplicates"])
+            with profiler.stage("deduplicate", len(df)) as stage:
+                df = duplicate_filter.drop_seen(df)
+                stage["rows_out"] = len(df)
+            deduplicated += len(df)
+            rows = df.index
+
+            df = df.set_index("dedup_index")
+            if first:
+                audit.write_header(df, COMPILED_RULES.sheet_names)
+            codes, field_codes = COMPILED_RULES.match(df, profiler)
+            with profiler.stage("exclusion workbook", len(df)) as stage:
+                sheets = sheet_codes(COMPILED_RULES, codes, field_codes)
+                # The duplicates sheet comes first in the workbook.
+                audit.write(df, numpy.where(sheets >= 0, sheets + 1, -1))
+                stage["rows_out"] = (sheets >= 0).sum()
+            counts, field_counts = rule_counts(COMPILED_RULES, codes, field_codes)
+            profile_rules(profiler, COMPILED_RULES, df, counts, singles)
+            if rule_totals is None:
+                rule_totals = (counts, field_counts)
+            else:
+                rule_totals = (
+                    rule_totals[0] + counts,
+                    {k: rule_totals[1][k] + v for k, v in field_counts.items()},
+                )
+            keys.loc[rows, "decision"] = RULE_DECISIONS[codes]
+            df = df[codes == COMPILED_RULES.no_match]
+            remaining += len(df)
+            if store is not None:
+                with profiler.stage("record store", len(parsed)):
+                    store.write_records(name, parsed, keys, first)
+
+            df = tidy_processed(df, name)
+            # Resumes when the chunk has been written.
+            with profiler.stage("write", len(df)) as stage:
+                yield df
+                stage["rows_out"] = len(df)
+
+    try:
+        intermediate.write_batches(processed_chunks(), processed_path(name), index=True)
+        duplicates = duplicate_filter.duplicates()
+        audit.write(duplicates, numpy.zeros(len(duplicates), dtype=int))
+        write_decisions(pandas.concat(decisions, ignore_index=True), name)
+    finally:
+        with profiler.stage("exclusion workbook"):
+            audit.close()
+        if store is not None:
+            store.close()
+
+    pre_2014, no_abstract_or_title, abstract_single_sentence = prefilter_counts[:3]
+    print(f"Found {found} records")
+    print(f"Removed {pre_2014} entries published before 2014")
+    result_series = [found - pre_2014]
     print(
-        f"Removed {no_abstract_or_title.sum()} entries with no available title, abstract, journal name, or year."
+        f"Removed {no_abstract_or_title} entries with no available title, abstract, journal name, or year."
     )
-    result_series.append(no_abstract_or_title.sum())
-
-    abstract_single_sentence = df["abstract"].apply(lambda a: len(a.split(".")) == 2)
-    df = df[~abstract_single_sentence].copy()
+    result_series.append(no_abstract_or_title)
     print(
-        f"Removed {abstract_single_sentence.sum()} entries with a single sentence in the abstract."
+        f"Removed {abstract_single_sentence} entries with a single sentence in the abstract."
     )
-    result_series.append(abstract_single_sentence.sum())
-
-    if "language" in df.columns:
-        non_eng = ~(
-            df["language"].str.contains("eng")
-            | df["language"].str.contains("English")
-            | df["language"].isna()
-        )
-        if non_eng.sum() > 0:
-            print(df[non_eng]["language"].value_counts())
-        df = df[~non_eng]
-        print(f"Removed {non_eng.sum()} entries where the language was not English.")
-        result_series.append(non_eng.sum())
+    result_series.append(abstract_single_sentence)
+    if len(prefilter_counts) > 3:
+        if len(languages) > 0:
+            print(languages.astype(int).sort_values(ascending=False))
+        print(f"Removed {prefilter_counts[3]} entries where the language was not English.")
+        result_series.append(prefilter_counts[3])
     else:
         result_series.append(0)
+    print_timings(timings)
+    print(f"Dropped {duplicate_filter.count()} duplicate records")
+    result_series.append(duplicate_filter.count())
 
-    # Remove surrounding quotes and full stops from titles.
-    df["title"] = df["title"].apply(tidy_title)
+    print_rule_counts(COMPILED_RULES, *rule_totals, deduplicated)
+    result_series.extend(rule_totals[0])
+    print(f"Continuing analysis with {remaining} remaining records...")
+    result_series.append(remaining)
 
-    # Remove newlines in authors and abstracts
-    sep = "," if name == "pubmed" else ";"
-    df["authors"] = df["authors"].apply(partial(tidy_authors, sep=sep))
-    df["first_author_surname"] = df["authors"].apply(first_author_surname)
-    df["abstract"] = df["abstract"].apply(remove_line_breaks).apply(lambda s: unidecode(s))
-    df["dedup_index"] = df.apply(make_dedup_index, axis=1)
-
-    with pandas.ExcelWriter(
-        f"outputs/basic-processing/basic-exclusions/{name}-exclusions.xlsx"
-    ) as excelwriter:
-        l = len(df)
-        dropped_dupes = df.drop_duplicates(subset=["title", "year", "first_author_surname"])
-        # dropped_dupes = df.drop_duplicates(subset=["title", "year"])
-        # Save the duplicates
-        pandas.concat([df, dropped_dupes]).drop_duplicates(keep=False).to_excel(
-            excelwriter, sheet_name="duplicates"
-        )
-        df = dropped_dupes
-        print(f"Dropped {l - len(df)} duplicate records")
-        result_series.append(l - len(df))
-
-        df.set_index("dedup_index", inplace=True)
-        df = remove_journal_phrases(
-            df, ["opinion"], "opinion", excelwriter, result_series
-        )
-        df = remove_journal_phrases(
-            df, ["medical hypotheses"], "hypotheses", excelwriter, result_series
-        )
-        df = remove_journal_phrases(
-            df,
-            [
-                "veterinary",
-                "animals",
-                "cattle",
-                "equine",
-                "wildlife",
-                "ruminants",
-            ],
-            "animal-focused journals",
-            excelwriter,
-            result_series,
-        )
-        df = remove_journal_phrases(
-            df, ["transplantation"], "transplant", excelwriter, result_series
-        )
-        df = remove_journal_phrases(
-            df, ["tropical"], "tropical medicine", excelwriter, result_series
-        )
-        df = remove_journal_phrases(
-            df,
-            ["surgical infection"],
-            "surgical infection",
-            excelwriter,
-            result_series,
-        )
-        df = remove_journal_phrases(
-            df, ["resuscitation"], "resuscitation", excelwriter, result_series
-        )
-        df = remove_journal_phrases(
-            df,
-            [
-                r"\baids\b",
-                r"\bhiv\b",
-                "sexually transmitted disease",
-            ],
-            "HIV-AIDS specific journals",
-            excelwriter,
-            result_series,
-        )
-        df = remove_journal_phrases(
-            df,
-            [
-                "engineering",
-                "acta mechanica",
-                "aerospace",
-                "thin-walled structures",
-                "technologies",
-                "steel construction",
-                "revista materia",
-                "physics of fluids",
-            ],
-            "engineering",
-            excelwriter,
-            result_series,
-        )
-        df = remove_journal_phrases(
-            df,
-            [
-                "anaesthesia",
-                "anesthesia",
-                "anaesthesiology",
-                "anesthesiology",
-                "acta anaesthesiologica",
-                "anestezi dergisi",
-                "anestesiologica",
-                "anesteziologiia",
-                "anestezjologia",
-            ],
-            "anaesthesia specific journals",
-            excelwriter,
-            result_series,
-        )
-        df = remove_publication_type(
-            df, "book", excelwriter, result_series
-        )  # book chapter
-        df = remove_publication_type(df, "news", excelwriter, result_series)
-        df = remove_publication_type(
-            df,
-            "guideline",
-            excelwriter,
-            result_series,
-        )  # guideline, practice guideline
-        df = remove_publication_type(df, "biography", excelwriter, result_series)
-        df = remove_publication_type(
-            df, "legal", excelwriter, result_series
-        )  # legal case
-        df = remove_publication_type(df, "proceedings", excelwriter, result_series)
-        df = remove_publication_type(df, "exam questions", excelwriter, result_series)
-        df = remove_publication_type(
-            df, "teaching material", excelwriter, result_series
-        )
-        df = remove_publication_type(df, "preprint", excelwriter, result_series)
-        df = remove_title_publication_type(
-            df,
-            title_phrases=[
-                "poster presentation",
-            ],
-            pub_types=[
-                "conference",
-            ],
-            name="conference",
-            excelwriter=excelwriter,
-            result_series=result_series,
-        )
-        df = remove_title_publication_type(
-            df,
-            title_phrases=[
-                "statement of retraction",
-            ],
-            pub_types=[
-                "retract",
-            ],
-            name="retracted",
-            excelwriter=excelwriter,
-            result_series=result_series,
-        )
-        df = remove_title_publication_type(
-            df,
-            title_phrases=[
-                ": protocol",
-                "study protocol",
-                "protocol for a",
-            ],
-            pub_types=[
-                "protocol",  # clinical trial protocol
-            ],
-            name="protocol",
-            excelwriter=excelwriter,
-            result_series=result_series,
-        )
-        df = remove_title_publication_type(
-            df,
-            title_phrases=[
-                "author",  # author's reply, author's response
-                "editor",  # editorial, editor's reply, letter to the editor
-                "comment",  # comment on, commentary, response to comments
-                "letter",  # letter of reply, letter to, response to letter
-                "^re:",
-                "committee opinion",
-            ],
-            pub_types=[
-                "comment",
-                "editorial",
-                "erratum",  # <- will find articles with erratum when retrieving full text.
-                "letter",
-            ],
-            name="commentary",
-            excelwriter=excelwriter,
-            result_series=result_series,
-        )
-        df = remove_title_phrases(
-            df,
-            [
-                "design of a",  # Study design / methodology
-                "methodology",
-            ],
-            "methodology",
-            excelwriter=excelwriter,
-            result_series=result_series,
-        )
-        df = remove_title_publication_type(
-            df,
-            title_phrases=[
-                ": a meta.?analysis",
-                "^(?:a )? meta.?analysis",
-                "narrative review",
-                "systematic review",
-                "scoping review",
-                "umbrella review",
-                "a (?:systematic )?literature review",
-                "state.of.the.art review",
-                "review of the literature",
-                "overview",
-            ],
-            pub_types=[
-                "review",
-                "meta.?analysis",
-            ],
-            name="systematic review",
-            journal_phrase="systematic review",
-            excelwriter=excelwriter,
-            result_series=result_series,
-        )
-        df = remove_title_phrases(
-            df,
-            [
-                "cohort profile",  # Profile of a cohort
-            ],
-            "cohort profile",
-            excelwriter=excelwriter,
-            result_series=result_series,
-        )
-
-        df = remove_title_publication_type(
-            df,
-            title_phrases=[
-                r"case.(?:report|description|summary|study|series)",
-                "conse[cq]utive.case",
-                "conse[cq]utive.patient",
-                r"series of (?:\d{1,2} )case",
-                r"series of (?:\d{1,2} )patient",
-                "review of case",
-                r"\b\d{1,2} (?:new )?case",
-            ]
-            + [f"[^-]{num2words(n)} case" for n in range(1, 21)],
-            pub_types=[
-                "case",  # case reports
-            ],
-            name="case report or case series",
-            journal_phrase="case",
-            excelwriter=excelwriter,
-            result_series=result_series,
-        )
-
-    print(f"Continuing analysis with {len(df)} remaining records...")
-    result_series.append(len(df))
+    profiler.add("process", time.perf_counter() - start, found, remaining)
+    profiler.write(profiling.profile_path(name))
+    return result_series
 
-    df = df.rename(columns={"country": "publish_country"})
-    df["doi"] = df["doi"].apply(tidy_doi)
-    df["source"] = name
 
-    df.to_csv(f"outputs/basic-processing/{name}.csv")
+SOURCES = ["pubmed", "cinahl", "medline", "psycinfo", "embase", "scopus"]
 
-    return result_series
+SUMMARY_INDEX = [
+    "total records",
+    "missing abstract, title, or year",
+    "single sentence in abstract",
+    "not published in English",
+    "duplicates",
+] + [r.summary for r in EXCLUSION_RULES] + ["remaining articles"]
 
 
-def main():
+def source_path(name):
+    return f"outputs/database-search-results/{name}"
+
+
+def processed_path(name):
+    return f"outputs/basic-processing/{name}"
+
+
+def exclusions_path(name):
+    return f"outputs/basic-processing/basic-exclusions/{name}-exclusions.xlsx"
+
+
+def decisions_path(name):
+    return f"outputs/basic-processing/decisions/{name}"
+
+
+def write_decisions(decisions, name):
+    # Records removed by prefilter() without a pmid or doi cannot be told
+    # apart from new ones, so are not kept.
+    decisions = decisions.dropna(subset=["pmid", "doi", "dedup_index"], how="all")
+    os.makedirs(os.path.dirname(decisions_path(name)), exist_ok=True)
+    intermediate.write_frame(decisions, decisions_path(name))
+
+
+def rule_config():
+    # Everything about the rules that affects process() output, for cache keys.
+    return [(r.name, r.patterns) for r in EXCLUSION_RULES]
+
+
+def write_summary(results):
+    # results maps source name to the result_series returned by process().
     result_df = pandas.DataFrame()
-    result_df["pubmed"] = process("pubmed", "outputs/database-search-results/pubmed.csv")
-    result_df["cinahl"] = process("cinahl", "outputs/database-search-results/cinahl.csv")
-    result_df["medline"] = process("medline", "outputs/database-search-results/medline.csv")
-    result_df["psycinfo"] = process("psycinfo", "outputs/database-search-results/psycinfo.csv")
-    result_df["embase"] = process("embase", "outputs/database-search-results/embase.csv")
-    result_df["scopus"] = process("scopus", "outputs/database-search-results/scopus.csv")
-
-    result_df["index"] = [
-        "total records",
-        "missing abstract, title, or year",
-        "single sentence in abstract",
-        "not published in English",
-        "duplicates",
-        "journal name: opinion",
-        "journal name: hypotheses",
-        "journal name: veterinary",
-        "journal name: transplant",
-        "journal name: tropical medicine",
-        "journal name: surgical infection",
-        "journal name: resuscitation",
-        "journal name: HIV-AIDs",
-        "journal name: engineering",
-        "journal name: anaesthesia",
-        "publication type: book chapter",
-        "publication type: news article",
-        "publication type: guideline",
-        "publication type: biography",
-        "publication type: legal case",
-        "publication type: conference proceedings",
-        "publication type: exam question",
-        "publication type: teaching material",
-        "publication type: preprint",
-        "publication type: conference or poster presentation",
-        "detected article type: retracted",
-        "detected article type: protocol",
-        "detected article type: commentary",
-        "detected article type: methodology",
-        "detected article type: systematic review",
-        "detected article type: cohort profile",
-        "detected article type: case report or case series",
-        "remaining articles",
-    ]
+    for name in SOURCES:
+        result_df[name] = results[name]
+    result_df["index"] = SUMMARY_INDEX
     result_df.set_index("index", inplace=True)
     result_df.to_csv("outputs/basic-processing/basic-processing-summary.csv")
+    profiling.concatenate(
+        [profiling.profile_path(name) for name in SOURCES],
+        "outputs/basic-processing/basic-processing-profile.jsonl",
+    )
+
+
+def main():
+    write_summary({name: process(name, source_path(name)) for name in SOURCES})
 
 
 if __name__ == "__main__":
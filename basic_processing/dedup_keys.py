@@ -0,0 +1,126 @@
+# Fixed-width keys for deduplication.
+#
+# Records are matched on 64-bit hashes of their key values, held in an index
+# of integers, rather than on the values themselves: the dedup index strings
+# average ~150 characters and abstracts far more. The hashes are Python's own,
+# which strings cache, so each value is hashed once however often it is looked
+# up, and which treat equal numbers alike (a pmid read as 123 or 123.0 is the
+# same key, as it was in a set). They differ from one run to the next, so are
+# never saved. A KeyIndex keeps each key's values alongside its hash, to
+# confirm that equal hashes are equal values and to check keys given by value,
+# such as the manually identified duplicates. If two different keys ever share a hash, the
+# index falls back to comparing the values themselves.
+
+import numpy
+import pandas
+
+# Mixes the hashes of a key's columns.
+MULTIPLIER = numpy.uint64(1000003)
+
+
+def key_values(data):
+    # The key values of data (a Series or DataFrame of key columns) as an
+    # object array with one row per key, with empty strings and NaN as None,
+    # and whether each key is missing (null in every column).
+    if isinstance(data, pandas.Series):
+        data = data.to_frame()
+    values = data.to_numpy(dtype=object, copy=True)
+    null = pandas.isna(values) | (values == "")
+    values[null] = None
+    return values, null.all(axis=1)
+
+
+def hash_keys(values):
+    # One 64-bit hash per row of key_values.
+    result = numpy.zeros(len(values), dtype=numpy.uint64)
+    for column in values.T:
+        hashes = numpy.fromiter(map(hash, column), dtype=numpy.int64, count=len(column))
+        result = result * MULTIPLIER ^ hashes.view(numpy.uint64)
+    return result
+
+
+def first_occurrences(hashes):
+    # The position of the first row with each row's hash.
+    codes, uniques = pandas.factorize(hashes)
+    first = numpy.empty(len(uniques), dtype=numpy.intp)
+    rows = numpy.arange(len(hashes))
+    first[codes[::-1]] = rows[::-1]
+    return first[codes]
+
+
+def same_values(a, b):
+    return (a == b).all(axis=1)
+
+
+class KeyIndex:
+    # A set of keys, held as their hashes for lookups and their values for
+    # checking matches.
+    def __init__(self):
+        self.hashes = pandas.Index(numpy.empty(0, dtype=numpy.uint64))
+        self.values = None
+        # The values as a set of tuples, once two keys have shared a hash.
+        self.exact = None
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def seen(self, data):
+        # Whether each row's key is already in the index or appears in an
+        # earlier row of data. Missing keys are never treated as seen.
+        return self.seen_values(*key_values(data))
+
+    def seen_values(self, values, missing):
+        hashes = hash_keys(values)
+        if self.exact is None:
+            result = self.seen_hashes(hashes, values, missing)
+            if result is not None:
+                return result
+            print("Two dedup keys share a hash; comparing key values from now on")
+            self.exact = set(map(tuple, self.values)) if self.values is not None else set()
+        result = numpy.zeros(len(values), dtype=bool)
+        batch = set()
+        for i, v in enumerate(map(tuple, values)):
+            if missing[i]:
+                continue
+            result[i] = v in self.exact or v in batch
+            batch.add(v)
+        return result
+
+    def seen_hashes(self, hashes, values, missing):
+        # As seen_values(), or None if a matching hash turns out to be a different
+        # key.
+        position = self.hashes.get_indexer(hashes)
+        in_index = position >= 0
+        if in_index.any() and not same_values(
+            self.values[position[in_index]], values[in_index]
+        ).all():
+            return None
+        first = first_occurrences(hashes)
+        repeated = first != numpy.arange(len(hashes))
+        if not same_values(values[first[repeated]], values[repeated]).all():
+            return None
+        # Missing keys all share one hash.
+        return (in_index | repeated) & ~missing
+
+    def add(self, data):
+        # Adds the keys of data that are not missing or already in the index.
+        values, missing = key_values(data)
+        values = values[~(self.seen_values(values, missing) | missing)]
+        if self.exact is not None:
+            self.exact.update(map(tuple, values))
+        self.hashes = self.hashes.append(pandas.Index(hash_keys(values)))
+        self.values = values if self.values is None else numpy.concatenate([self.values, values])
+
+    def contains(self, data):
+        # Whether each row's key is in the index, leaving the index unchanged.
+        values, missing = key_values(data)
+        if self.values is None:
+            return numpy.zeros(len(values), dtype=bool)
+        if self.exact is not None:
+            return numpy.fromiter(
+                (v in self.exact for v in map(tuple, values)), dtype=bool, count=len(values)
+            )
+        position = self.hashes.get_indexer(hash_keys(values))
+        result = position >= 0
+        result[result] = same_values(self.values[position[result]], values[result])
+        return result & ~missing
@@ -0,0 +1,251 @@
+# Refreshes the outputs for a source from a new export, processing only the
+# records that were not in the previous one.
+#
+# process() saves the identifiers (pmid, doi and dedup_index) of every record
+# it reads, with what became of it. A record of the new export with an
+# identifier seen before keeps its earlier decision; the rest go through the
+# same filters, deduplication and exclusion rules as in process(). Earlier
+# records with no identifier in the new export are retracted. The source's
+# processed records, the merged records and the saved decisions are then
+# updated, and the changes are written to
+# outputs/basic-processing/delta/<source>-delta.xlsx.
+#
+# In the merged records, as in a full merge, a new record replaces a copy from
+# a source later in the merge order, and a record that was not merged because
+# it matched a removed one may take its place.
+#
+# Usage: parse the new export as usual, then
+#        python basic_processing/delta.py SOURCE [SOURCE ...]
+
+import argparse
+import os
+import sys
+
+import numpy
+import pandas
+
+import basic_processing
+import intermediate
+import merge_datasets
+from normalise import normalise
+
+KEYS = ["pmid", "doi", "dedup_index"]
+REPORT_DIR = "outputs/basic-processing/delta"
+
+
+def report_path(name):
+    return f"{REPORT_DIR}/{name}-delta.xlsx"
+
+
+def tidy_key(v):
+    v = intermediate.tidy_string(v)
+    # pmids written from a float column read back from CSV as e.g. "123.0".
+    if v is not None and v.endswith(".0") and v[:-2].isdigit():
+        return v[:-2]
+    return v
+
+
+def tidy_keys(df, keys=KEYS):
+    # The identifiers of df's records, in one form whichever file they came
+    # from. dedup_index may be df's index.
+    result = pandas.DataFrame(index=df.index)
+    for k in keys:
+        values = df.index.to_series() if k == df.index.name else df[k]
+        result[k] = values.map(tidy_key)
+    return result
+
+
+def concat(frames, **kwargs):
+    # pandas.concat, leaving out the empty frames (whose columns pandas will
+    # stop ignoring when typing the result) unless every frame is empty, but
+    # keeping their columns.
+    frames = list(frames)
+    result = pandas.concat([df for df in frames if len(df) > 0] or frames[:1], **kwargs)
+    columns = frames[0].columns.append([df.columns for df in frames[1:]]).unique()
+    return result if len(columns) == len(result.columns) else result.reindex(columns=columns)
+
+
+def key_sets(keys):
+    return {k: set(keys[k].dropna()) for k in keys.columns}
+
+
+def seen(keys, known):
+    # Whether each record shares an identifier with the known records.
+    result = numpy.zeros(len(keys), dtype=bool)
+    for k, values in known.items():
+        if k in keys.columns:
+            result |= keys[k].isin(values).to_numpy()
+    return result
+
+
+def exists(stem):
+    return any(os.path.exists(intermediate.path(stem, f)) for f in intermediate.FORMATS)
+
+
+def classify(name, export, previous):
+    # Returns the new export's records that were not in the previous export
+    # and pass every filter and rule, as process() writes them; the keys and
+    # decisions of the export's records; and which of them are new.
+    keys = basic_processing.record_keys(export)
+    known = key_sets(previous[KEYS])
+    new = ~seen(keys[["pmid", "doi"]], known)
+
+    df, _, _ = basic_processing.prefilter(export[new])
+    normalise(df, "," if name == "pubmed" else ";")
+    keys.loc[df.index, "dedup_index"] = df["dedup_index"]
+    keys.loc[df.index, "decision"] = "duplicate"
+    old = df["dedup_index"].isin(known["dedup_index"])
+    new[export.index.get_indexer(df.index[old])] = False
+    df = basic_processing.DuplicateFilter().drop_seen(df[~old])
+
+    rows = df.index
+    df = df.set_index("dedup_index")
+    codes, _ = basic_processing.COMPILED_RULES.match(df)
+    keys.loc[rows, "decision"] = basic_processing.RULE_DECISIONS[codes]
+    df = df[codes == basic_processing.COMPILED_RULES.no_match]
+    return basic_processing.tidy_processed(df, name), keys, new
+
+
+def merge_keys(df):
+    return tidy_keys(df, merge_datasets.DEDUP_KEYS)
+
+
+def merge_group(keys, source, data):
+    # Merges in the records of data from source that merge_set() would have
+    # kept, given the merged keys of this and earlier sources, and drops the
+    # copies of them that later sources had added. Returns the merged keys,
+    # the records merged in and the keys dropped.
+    order = {s: i for i, s in enumerate(merge_datasets.MERGE_ORDER)}
+    if "lower_abstract" not in data.columns:
+        data = data.assign(
+            lower_abstract=data["abstract"].apply(merge_datasets.normalise_abstract)
+        )
+    rank = keys["source"].map(order).to_numpy()
+    index = merge_datasets.DedupIndex.from_frame(keys[rank <= order[source]])
+    data_keys = merge_keys(data).reset_index(drop=True)
+    for key in merge_datasets.DEDUP_KEYS:
+        data_keys = index.drop_seen(data_keys, key)
+    data = data.iloc[data_keys.index]
+
+    later = keys[rank > order[source]]
+    replaced = later[seen(later, key_sets(data_keys))]
+    keys = concat(
+        [keys.drop(replaced.index), data_keys.assign(source=source)], ignore_index=True
+    )
+    return keys, data, replaced.assign(reason=f"replaced by a record from {source}")
+
+
+def update_merged(name, added, retracted_kept):
+    # Returns the merged records and their keys with the retracted records
+    # removed and the added ones merged in, the records that were merged in,
+    # and the records that were removed, with the reason.
+    merged = pandas.read_csv(
+        merge_datasets.MERGED_PATH, index_col=0, dtype=str, keep_default_na=False, na_values=[""]
+    )
+    keys = intermediate.read_frame(merge_datasets.MERGED_KEYS_PATH)
+    keys[merge_datasets.DEDUP_KEYS] = merge_keys(keys)
+    order = {s: i for i, s in enumerate(merge_datasets.MERGE_ORDER)}
+
+    retracted = (keys["source"] == name) & keys["dedup_index"].isin(retracted_kept)
+    lost = [keys[retracted].assign(reason="no longer exported")]
+    keys = keys[~retracted]
+    keys, data, replaced = merge_group(keys, name, added)
+    merged_in = [data]
+    lost.append(replaced)
+
+    # Records of this and later sources that were not merged because they
+    # matched a record that has now been removed may take its place.
+    if any(len(df) > 0 for df in lost):
+        known = key_sets(concat(lost)[merge_datasets.DEDUP_KEYS])
+        for source in merge_datasets.MERGE_ORDER[order[name] :]:
+            data = intermediate.read_frame(basic_processing.processed_path(source))
+            data = data.set_index("dedup_index")
+            data = data[~data.index.isin(keys["dedup_index"])]
+            data = data.assign(
+                lower_abstract=data["abstract"].apply(merge_datasets.normalise_abstract)
+            )
+            keys, data, replaced = merge_group(keys, source, data[seen(merge_keys(data), known)])
+            merged_in.append(data)
+            lost.append(replaced)
+
+    lost = concat(lost)
+    reasons = lost.set_index("dedup_index")["reason"]
+    removed = merged[merged.index.isin(reasons.index)]
+    removed = removed.assign(reason=reasons.reindex(removed.index).to_numpy())
+    merged_in = concat(merged_in)
+    merged_in = merged_in[~merged_in.index.isin(merge_datasets.MANUAL_DUPLICATES)]
+    merged = concat([merged.drop(removed.index), merged_in])
+
+    # New records go after the others from their source.
+    merged = merged.iloc[
+        numpy.argsort(merged["source"].map(order).to_numpy(), kind="stable")
+    ]
+    columns = [c for c in merged.columns if c != "lower_abstract"]
+    merged = merged[columns + ["lower_abstract"]]
+    return merged, keys, merged_in, removed
+
+
+def update(name):
+    print(f"\n\nUpdating {name}")
+    decisions_path = basic_processing.decisions_path(name)
+    for stem in [decisions_path, merge_datasets.MERGED_KEYS_PATH]:
+        if not exists(stem):
+            raise FileNotFoundError(
+                f"No {stem} from an earlier run; run basic processing and merging first"
+            )
+    previous = intermediate.read_frame(decisions_path)
+    previous[KEYS] = tidy_keys(previous)
+    export = intermediate.read_frame(basic_processing.source_path(name))
+    added, keys, new = classify(name, export, previous)
+    print(f"Found {len(export)} records, {new.sum()} of them new")
+    decisions = keys[new]["decision"]
+    print(decisions.value_counts().to_string())
+
+    # Earlier records with no identifier in the new export.
+    current = key_sets(tidy_keys(keys))
+    gone = ~seen(previous[KEYS], current)
+    retracted = previous[gone]
+    print(f"Retracted {gone.sum()} records that are no longer exported")
+
+    processed = intermediate.read_frame(basic_processing.processed_path(name))
+    retracted_kept = retracted.loc[retracted["decision"] == "kept", "dedup_index"]
+    processed = processed[~processed["dedup_index"].isin(retracted_kept)]
+    processed = concat([processed, added.reset_index()], ignore_index=True)
+    intermediate.write_frame(
+        processed.set_index("dedup_index"), basic_processing.processed_path(name)
+    )
+
+    merged, merged_keys, merged_in, removed = update_merged(name, added, retracted_kept)
+    print(f"Merged {len(merged_in)} records and removed {len(removed)}, now {len(merged)}")
+    merged.to_csv(merge_datasets.MERGED_PATH)
+    intermediate.write_frame(merged_keys, merge_datasets.MERGED_KEYS_PATH)
+
+    basic_processing.write_decisions(
+        concat([previous[~gone], keys[new]], ignore_index=True), name
+    )
+
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    excluded = export[new & (keys["decision"] != "kept").to_numpy()]
+    with pandas.ExcelWriter(report_path(name)) as writer:
+        merged_in.to_excel(writer, sheet_name="merged")
+        removed.to_excel(writer, sheet_name="removed")
+        excluded.assign(decision=decisions).to_excel(writer, sheet_name="excluded")
+        added[~added.index.isin(merged_in.index)].to_excel(
+            writer, sheet_name="already merged"
+        )
+    print(f"Wrote {report_path(name)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sources", nargs="+", choices=basic_processing.SOURCES)
+    args = parser.parse_args()
+    for name in args.sources:
+        update(name)
+    print(
+        "\nRe-run basic_processing/near_duplicates.py to refresh the near-duplicate review."
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+# Writes the exclusion workbook for a source.
+#
+# Excluded records are tagged with the sheet they belong on while they are
+# filtered, and appended row by row to a write-only openpyxl workbook, which
+# streams each sheet to a temporary file rather than building every sheet in
+# memory until the workbook is closed. Cells are written as pandas' to_excel
+# writes them, so the sheets are unchanged. With background=True, rows are
+# written by a separate thread fed through a bounded queue.
+
+import queue
+import threading
+
+import numpy
+import pandas
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
+
+THIN = Side(style="thin")
+HEADER_FONT = Font(bold=True)
+HEADER_BORDER = Border(top=THIN, right=THIN, bottom=THIN, left=THIN)
+HEADER_ALIGNMENT = Alignment(horizontal="center", vertical="top")
+
+# Frames waiting to be written by the background thread.
+QUEUE_SIZE = 8
+
+
+def cell_value(v):
+    # As pandas' Excel writer formats values.
+    if pandas.api.types.is_scalar(v) and pandas.isna(v):
+        return ""
+    if pandas.api.types.is_integer(v):
+        return int(v)
+    if pandas.api.types.is_float(v):
+        v = float(v)
+        if v == float("inf"):
+            return "inf"
+        if v == float("-inf"):
+            return "-inf"
+        return v
+    if pandas.api.types.is_bool(v):
+        return bool(v)
+    return str(v)
+
+
+class ExclusionWorkbook:
+    def __init__(self, path, sheet_names, background=False):
+        self.path = path
+        self.book = Workbook(write_only=True)
+        # Sheets appear in the workbook in this order, whenever they are
+        # written to.
+        self.names = list(sheet_names)
+        self.sheets = {name: self.book.create_sheet(name) for name in self.names}
+        self.queue = None
+        self.error = None
+        if background:
+            self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+            self.thread = threading.Thread(target=self.drain)
+            self.thread.start()
+
+    def header_cell(self, sheet, v):
+        cell = WriteOnlyCell(sheet, cell_value(v))
+        cell.font = HEADER_FONT
+        cell.border = HEADER_BORDER
+        cell.alignment = HEADER_ALIGNMENT
+        return cell
+
+    def write_header(self, df, names):
+        # Writes the column names of df (and the name of its index) as the
+        # first row of each of the sheets called names.
+        self.submit(("header", df.iloc[:0], names))
+
+    def write(self, df, codes):
+        # Appends each row of df to the sheet self.names[code], skipping rows
+        # whose code is negative.
+        codes = numpy.asarray(codes)
+        keep = codes >= 0
+        if keep.any():
+            self.submit(("rows", df[keep], codes[keep]))
+
+    def submit(self, task):
+        if self.queue is None:
+            self.run(task)
+        else:
+            if self.error is not None:
+                raise self.error
+            self.queue.put(task)
+
+    def run(self, task):
+        kind, df, arg = task
+        if kind == "header":
+            for name in arg:
+                sheet = self.sheets[name]
+                label = df.index.name
+                row = [self.header_cell(sheet, label) if label else None]
+                sheet.append(row + [self.header_cell(sheet, c) for c in df.columns])
+            return
+        sheets = [self.sheets[self.names[c]] for c in arg]
+        for sheet, row in zip(sheets, df.itertuples(name=None)):
+            sheet.append([self.header_cell(sheet, row[0])] + [cell_value(v) for v in row[1:]])
+
+    def drain(self):
+        while (task := self.queue.get()) is not None:
+            if self.error is not None:
+                continue
+            try:
+                self.run(task)
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        if self.queue is not None:
+            self.queue.put(None)
+            self.thread.join()
+            if self.error is not None:
+                raise self.error
+        self.book.save(self.path)
@@ -0,0 +1,250 @@
+# Reading and writing the tables passed between pipeline stages.
+#
+# Intermediate tables are written as Parquet by default, with explicit column
+# types and dictionary encoding for the repetitive columns, so later stages do
+# not re-parse long abstracts or re-guess dtypes. Set INTERMEDIATE_FORMAT=csv
+# (or run without pyarrow installed) to keep the original CSV files.
+#
+# Paths are given without an extension; the extension follows the format.
+
+import os
+
+import numpy
+import pandas
+
+from overlap import prefetch
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+FORMATS = ["parquet", "csv"]
+
+STRING_COLUMNS = [
+    "pmid",
+    "title",
+    "authors",
+    "abstract",
+    "doi",
+    "journal",
+    "language",
+    "mesh terms",
+    "publication types",
+    "pubtype",
+    "country",
+    "publish_country",
+    "first_author_surname",
+    "dedup_index",
+    "lower_abstract",
+    "source",
+    "decision",
+]
+FLOAT_COLUMNS = ["year"]
+
+# Columns with few distinct values, stored dictionary-encoded.
+DICTIONARY_COLUMNS = [
+    "journal",
+    "language",
+    "publication types",
+    "pubtype",
+    "country",
+    "publish_country",
+    "source",
+    "decision",
+    "year",
+]
+# The string columns among them, which are read back as pandas categoricals:
+# each distinct value is held once, with a small integer code per row, and
+# string methods such as str.contains run once per distinct value. Other
+# stages treat them as they would strings.
+CATEGORY_COLUMNS = [c for c in DICTIONARY_COLUMNS if c in STRING_COLUMNS]
+CATEGORY_DTYPES = {c: "category" for c in CATEGORY_COLUMNS}
+
+
+def intermediate_format():
+    f = os.environ.get("INTERMEDIATE_FORMAT", "parquet")
+    if f not in FORMATS:
+        raise ValueError(f"Unknown intermediate format {f}; expected one of {FORMATS}")
+    if f == "parquet" and pyarrow is None:
+        return "csv"
+    return f
+
+
+def path(stem, f=None):
+    return f"{stem}.{f or intermediate_format()}"
+
+
+def read_format(stem):
+    # The format read_frame reads stem in: the intermediate format, except
+    # that it falls back to an existing CSV when no Parquet file has been
+    # written, e.g. for outputs produced before the switch.
+    f = intermediate_format()
+    if f == "parquet" and not os.path.exists(path(stem, "parquet")):
+        return "csv"
+    return f
+
+
+def read_path(stem):
+    # The file read_frame reads for stem, e.g. for a cache key.
+    return path(stem, read_format(stem))
+
+
+def tidy_string(v):
+    # Empty strings become nulls, as they would when read back from CSV.
+    if pandas.isna(v) or v == "":
+        return None
+    if isinstance(v, float) and v.is_integer():
+        # Numeric identifiers such as pmids read back as floats.
+        return str(int(v))
+    return str(v)
+
+
+def to_table(df):
+    # Drop an unnamed positional index, keep a named one as a column.
+    if df.index.name is None:
+        df = df.reset_index(drop=True)
+    else:
+        df = df.reset_index()
+    df = df.copy()
+    fields = []
+    for column in df.columns:
+        if column in STRING_COLUMNS:
+            df[column] = df[column].map(tidy_string).astype(object)
+            fields.append(pyarrow.field(column, pyarrow.string()))
+        elif column in FLOAT_COLUMNS:
+            # As floats, nullable integers included, so that every source's
+            # years read back alike.
+            df[column] = pandas.to_numeric(df[column], errors="coerce").astype(float)
+            fields.append(pyarrow.field(column, pyarrow.float64()))
+        else:
+            fields.append(pyarrow.Schema.from_pandas(df[[column]], preserve_index=False).field(column))
+    return pyarrow.Table.from_pandas(df, schema=pyarrow.schema(fields), preserve_index=False)
+
+
+def parquet_writer(stem, schema):
+    return pyarrow.parquet.ParquetWriter(
+        path(stem, "parquet"),
+        schema,
+        use_dictionary=[c for c in DICTIONARY_COLUMNS if c in schema.names],
+        compression="zstd",
+    )
+
+
+def write_frame(df, stem):
+    if intermediate_format() == "csv":
+        df.to_csv(path(stem, "csv"))
+        return
+    table = to_table(df)
+    with parquet_writer(stem, table.schema) as writer:
+        writer.write_table(table)
+
+
+def write_batches(frames, stem, index=False, quoting=None):
+    # Writes an iterable of DataFrames with the same columns as one table,
+    # one row group per frame, without holding them all in memory. index
+    # controls whether CSV output includes the frames' index, as write_frame
+    # does, and quoting (a csv.QUOTE_* constant) how its values are quoted;
+    # the header is left unquoted. The frames are produced on another thread
+    # (see overlap.py), so the next is computed while the last is written.
+    frames = prefetch(frames)
+    if intermediate_format() == "csv":
+        header = True
+        with open(path(stem, "csv"), "w", encoding="utf-8", newline="") as f:
+            for df in frames:
+                if header and quoting is not None:
+                    df.iloc[:0].to_csv(f, index=index)
+                    header = False
+                df.to_csv(f, header=header, index=index, quoting=quoting)
+                header = False
+        return
+    writer = None
+    try:
+        for df in frames:
+            table = to_table(df)
+            if writer is None:
+                writer = parquet_writer(stem, table.schema)
+            elif table.schema != writer.schema:
+                # e.g. a column that is entirely null in this frame
+                table = table.cast(writer.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def category_columns(parquet_path):
+    return [c for c in CATEGORY_COLUMNS if c in pyarrow.parquet.read_schema(parquet_path).names]
+
+
+def concat_frames(frames, **kwargs):
+    # pandas.concat, keeping the CATEGORY_COLUMNS categorical: concat
+    # decodes categoricals whose categories differ, so the frames are first
+    # given the categories of all of them, in order.
+    frames = list(frames)
+    dtypes = {}
+    for c in CATEGORY_COLUMNS:
+        columns = [df[c] for df in frames if c in df.columns]
+        if not any(isinstance(s.dtype, pandas.CategoricalDtype) for s in columns):
+            continue
+        values = [
+            s.cat.categories if isinstance(s.dtype, pandas.CategoricalDtype) else s.dropna().unique()
+            for s in columns
+        ]
+        dtypes[c] = pandas.CategoricalDtype(pandas.Index(numpy.concatenate(values)).unique())
+    frames = [df.astype({c: t for c, t in dtypes.items() if c in df.columns}) for df in frames]
+    # A column missing from some frames comes out of concat as objects.
+    return pandas.concat(frames, **kwargs).astype(dtypes)
+
+
+def read_frame(stem, columns=None, index=False):
+    # Reads stem in its read_format(). With index, a CSV's unnamed first
+    # column is read back as the index (Parquet tables are written without
+    # one).
+    f = read_format(stem)
+    if f == "csv":
+        if index:
+            df = pandas.read_csv(path(stem, "csv"), index_col=0, dtype=CATEGORY_DTYPES)
+            return df if columns is None else df[columns]
+        df = pandas.read_csv(path(stem, "csv"), usecols=columns, dtype=CATEGORY_DTYPES)
+        if "Unnamed: 0" in df.columns:
+            df = df.drop(columns="Unnamed: 0")
+        return df
+    table = pyarrow.parquet.read_table(
+        path(stem, "parquet"),
+        columns=columns,
+        memory_map=True,
+        read_dictionary=category_columns(path(stem, "parquet")),
+    )
+    return table.to_pandas()
+
+
+def iter_frames(stem, chunk_size=None):
+    # Reads a table chunk_size rows at a time, or whole if chunk_size is None.
+    # The frames' indexes continue from one to the next, as if the table had
+    # been read at once.
+    if chunk_size is None:
+        yield read_frame(stem)
+        return
+    f = read_format(stem)
+    if f == "csv":
+        for df in pandas.read_csv(
+            path(stem, "csv"), chunksize=chunk_size, dtype=CATEGORY_DTYPES
+        ):
+            if "Unnamed: 0" in df.columns:
+                df = df.drop(columns="Unnamed: 0")
+            yield df
+        return
+    start = 0
+    parquet_file = pyarrow.parquet.ParquetFile(
+        path(stem, "parquet"),
+        memory_map=True,
+        read_dictionary=category_columns(path(stem, "parquet")),
+    )
+    for batch in parquet_file.iter_batches(batch_size=chunk_size):
+        df = batch.to_pandas()
+        df.index = pandas.RangeIndex(start, start + len(df))
+        start += len(df)
+        yield df
@@ -1,147 +1,391 @@
+import functools
+import hashlib
+import os
 import re
 import sys
+import tempfile
 
+import numpy
 import pandas
 
+import dedup_keys
+from dedup_keys import KeyIndex
+import intermediate
+import near_duplicates
+from overlap import background, prefetch
+import profiling
+from profiling import Profiler
+import record_store
+import stage_cache
+
+
+# Abstracts are compared with spaces, punctuation, "s" (so plurals match) and
+# any trailing parenthetical or copyright notice removed. One pass removes the
+# characters, and "(s)" even when the characters removed were inside the
+# brackets, e.g. "( s )". The lookahead skips other brackets quickly.
+REMOVED_CHARACTERS = r"[\s;:-]|\+/?-"
+ABSTRACT_NOISE = re.compile(
+    rf"[\s;:s-]+|\+/?-|\((?=[\s;:+s-])(?:{REMOVED_CHARACTERS})*s(?:{REMOVED_CHARACTERS})*\)"
+)
+COPYRIGHT = re.compile(r"copyright|!\(c\)|\(c\)")
+# Abstracts whose normalised form is remembered in memory.
+NORMALISE_CACHE_SIZE = 2**16
+NORMALISED_ABSTRACTS_PATH = "outputs/basic-processing/normalised-abstracts"
+
 
 def scan_opening_brace(s):
+    # Index of the "(" matching the ")" that ends s, or None if there is none
+    # after the first character.
     depth = 0
-    print(s)
-    for i in range(len(s)-2, 0, -1):
-        c= s[i]
+    for i in range(len(s) - 2, 0, -1):
+        c = s[i]
         if c == ")":
-            print(s[:i])
             depth += 1
-        if c == "(" and depth == 0:
-            print(s[:i])
-            return i
         elif c == "(":
+            if depth == 0:
+                return i
             depth -= 1
 
 
+@functools.lru_cache(maxsize=NORMALISE_CACHE_SIZE)
 def normalise_abstract(s):
-    s = s.lower().strip()
-    s = re.sub(r"(?:\s+|;|:|\+\/-|\+-|-)", "", s)
-    s = re.sub(r"\(s\)", "", s)
-    s = re.sub(r"s", "", s)
-    if s[-1] == ")":
-        s = s[:scan_opening_brace(s)]
-    s = s.split("copyright")[0]
-    s = s.split("!(c)")[0]
-    s = s.split("(c)")[0]
-    return s
+    s = ABSTRACT_NOISE.sub("", s.lower())
+    if s.endswith(")"):
+        s = s[: scan_opening_brace(s)]
+    copyright = COPYRIGHT.search(s)
+    return s if copyright is None else s[: copyright.start()]
+
+
+def abstract_digest(s):
+    return hashlib.blake2b(s.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class NormalisedAbstracts:
+    # The normalised form of each abstract, by a digest of the abstract. With
+    # a path, those saved by an earlier merge are reused, as long as the
+    # normalisation is unchanged, and those looked up by a full merge are
+    # saved (see save()), so the file holds no more than the current
+    # exports'.
+    def __init__(self, path=NORMALISED_ABSTRACTS_PATH):
+        self.path = path
+        self.key = stage_cache.stage_key("normalise abstracts", code=[__file__])
+        self.known = {}
+        self.used = set()
+        self.added = 0
+        if path is None or not os.path.exists(f"{path}.key"):
+            return
+        with open(f"{path}.key") as f:
+            if f.read() != self.key:
+                return
+        saved = intermediate.read_frame(path)
+        # Empty strings read back as nulls.
+        self.known = dict(zip(saved["digest"], saved["lower_abstract"].fillna("")))
+
+    def normalise(self, abstracts):
+        result = []
+        for s in abstracts:
+            digest = abstract_digest(s)
+            self.used.add(digest)
+            normalised = self.known.get(digest)
+            if normalised is None:
+                normalised = self.known[digest] = normalise_abstract(s)
+                self.added += 1
+            result.append(normalised)
+        return pandas.Series(result, index=abstracts.index, dtype=object)
+
+    def save(self, prune=True):
+        # Saves the abstracts looked up by this merge, with the key of the
+        # code that normalised them. With prune, those of abstracts no longer
+        # in any export are dropped; without, as when the earlier sources'
+        # merges were restored from the cache and not looked up, all are kept.
+        dropped = prune and len(self.used) < len(self.known)
+        if self.path is None or (self.added == 0 and not dropped):
+            return
+        digests = [d for d in self.known if not prune or d in self.used]
+        intermediate.write_frame(
+            pandas.DataFrame(
+                {"digest": digests, "lower_abstract": [self.known[d] for d in digests]}
+            ),
+            self.path,
+        )
+        with open(f"{self.path}.key", "w") as f:
+            f.write(self.key)
+
+
+# Columns that identify a record, checked in this order when merging.
+DEDUP_KEYS = ["pmid", "doi", "lower_abstract", "dedup_index"]
+
+
+class DedupIndex:
+    # The records merged so far, with a KeyIndex of the values of each dedup
+    # key, so each new source is only checked against the index rather than
+    # re-deduplicating everything merged before it.
+    def __init__(self):
+        self.keys = {k: KeyIndex() for k in DEDUP_KEYS}
+        self.frames = []
+        self.length = 0
+        # The merged columns other than lower_abstract, in the order the
+        # sources brought them, and where lower_abstract goes among them.
+        self.sources = set()
+        self.columns = []
+        self.abstract_at = None
+
+    def __len__(self):
+        return self.length
+
+    @classmethod
+    def from_frame(cls, data):
+        index = cls()
+        index.add(data)
+        return index
+
+    def drop_seen(self, data, key):
+        # Drops rows whose key is already in the index or appears earlier in
+        # data. Missing values are never treated as duplicates.
+        return data[~self.keys[key].seen(data[key])]
+
+    def add(self, data):
+        for key in DEDUP_KEYS:
+            self.keys[key].add(data[key])
+        self.frames.append(data)
+        self.length += len(data)
+        # Columns are ordered as the original merge ordered them: each
+        # source's new columns in turn, with lower_abstract after those of
+        # the first two sources, when it was added. A merge restored from the
+        # cache has lower_abstract in place already.
+        columns = list(data.columns)
+        restored = len(self.frames) == 1 and "lower_abstract" in columns
+        if "source" in columns:
+            self.sources.update(data["source"].dropna().unique())
+        if self.abstract_at is None and len(self.sources) >= 2 and restored:
+            self.abstract_at = columns.index("lower_abstract")
+        self.columns += [c for c in columns if c not in self.columns and c != "lower_abstract"]
+        if self.abstract_at is None and len(self.sources) >= 2:
+            self.abstract_at = len(self.columns)
+
+    def merged(self):
+        result = intermediate.concat_frames(self.frames, ignore_index=True)
+        columns = list(self.columns)
+        at = len(columns) if self.abstract_at is None else self.abstract_at
+        return result[columns[:at] + ["lower_abstract"] + columns[at:]]
 
 
-def drop_non_na_duplicates(data, column):
-    return data[~data[column].duplicated() | data[column].isna()]
+def read_set(name, path, profiler):
+    with profiler.stage("merge: read", source=name) as stage:
+        data = intermediate.read_frame(path)
+        stage["rows_out"] = len(data)
+    return data
 
 
-def merge_set(name, path, combined_data):
+def merge_set(name, path, index, profiler=None, abstracts=None, store=None):
+    profiler = profiler or Profiler(name)
     print(f"\nMerging {name}")
-    data = pandas.read_csv(path)
+    merge_frame(name, read_set(name, path, profiler), index, profiler, abstracts, store)
 
-    original_data_length = len(data)
-    print(f"Found {len(data)} records.")
 
-    result = pandas.concat([combined_data, data], ignore_index=True)
-    original_combined_length = len(result)
-    print(f"Combined length: {original_combined_length}")
+def mark_dropped(decisions, data, decision):
+    # Records why the records no longer in data were dropped, if they were
+    # not dropped by an earlier step.
+    decisions[(decisions == "merged") & ~decisions.index.isin(data.index)] = decision
+
 
-    result = drop_non_na_duplicates(result, "pmid")
-    result = drop_non_na_duplicates(result, "doi")
+def merge_frame(name, data, index, profiler=None, abstracts=None, store=None):
+    # Adds the records of data that are not already in the index. abstracts
+    # is the NormalisedAbstracts to reuse, and store a RecordStore to write
+    # the merge decisions to.
+    profiler = profiler or Profiler(name)
+    if abstracts is None:
+        abstracts = NormalisedAbstracts(path=None)
+    print(f"Found {len(data)} records.")
+    print(f"Combined length: {len(index) + len(data)}")
+    source_data = data
+    decisions = pandas.Series("merged", index=data.index, dtype=object)
+
+    l = len(data)
+    with profiler.stage("merge: pmid and doi", l, name) as stage:
+        data = index.drop_seen(data, "pmid")
+        mark_dropped(decisions, data, "duplicate pmid")
+        data = index.drop_seen(data, "doi")
+        mark_dropped(decisions, data, "duplicate doi")
+        stage["rows_out"] = len(data)
     print(
-        f"Removed {original_combined_length - len(result)} duplicated pmids or dois, now {len(result)}"
+        f"Removed {l - len(data)} duplicated pmids or dois, now {len(index) + len(data)}"
     )
 
-    l = len(result)
-    result["lower_abstract"] = result["abstract"].apply(normalise_abstract)
-    result = drop_non_na_duplicates(result, "lower_abstract")
-    print(f"Removed {l - len(result)} identical abstracts, now {len(result)}")
+    l = len(data)
+    # Only the new source's abstracts are normalised; merged ones are indexed.
+    with profiler.stage("merge: normalise abstracts", l, name) as stage:
+        data = data.assign(lower_abstract=abstracts.normalise(data["abstract"]))
+        stage["rows_out"] = len(data)
+    lower_abstracts = data["lower_abstract"]
+    with profiler.stage("merge: abstracts", l, name) as stage:
+        data = index.drop_seen(data, "lower_abstract")
+        mark_dropped(decisions, data, "identical abstract")
+        stage["rows_out"] = len(data)
+    print(f"Removed {l - len(data)} identical abstracts, now {len(index) + len(data)}")
 
-    l = len(result)
-    result = result.drop_duplicates(["dedup_index"])
+    l = len(data)
+    with profiler.stage("merge: dedup index", l, name) as stage:
+        data = index.drop_seen(data, "dedup_index")
+        mark_dropped(decisions, data, "duplicate title/year/first author")
+        stage["rows_out"] = len(data)
     print(
-        f"Removed {l - len(result)} duplicate title/year/first author combos, now {len(result)}"
+        f"Removed {l - len(data)} duplicate title/year/first author combos, now {len(index) + len(data)}"
     )
 
-    print(f"Added {original_combined_length - len(result)} unique records")
-    print(f"Total records: {len(result)}")
-    return result
+    with profiler.stage("merge: add", len(data), name) as stage:
+        index.add(data)
+        stage["rows_out"] = len(index)
+    print(f"Added {len(data)} unique records")
+    print(f"Total records: {len(index)}")
 
+    if store is not None:
+        with profiler.stage("merge: record store", len(source_data), name):
+            store.write_merge_decisions(
+                name, source_data, decisions, lower_abstracts.map(abstract_digest)
+            )
 
-def main():
-    pubmed_data = pandas.read_csv("outputs/basic-processing/pubmed.csv")
-    print(f"Pubmed: {len(pubmed_data)}")
 
-    combined_data = merge_set(
-        "cinahl",
-        "outputs/basic-processing/cinahl.csv",
-        pubmed_data,
-    )
-    combined_data = merge_set(
-        "medline",
-        "outputs/basic-processing/medline.csv",
-        combined_data,
-    )
-    combined_data = merge_set(
-        "psycinfo",
-        "outputs/basic-processing/psycinfo.csv",
-        combined_data,
-    )
-    combined_data = merge_set(
-        "embase",
-        "outputs/basic-processing/embase.csv",
-        combined_data,
-    )
-    combined_data = merge_set(
-        "scopus",
-        "outputs/basic-processing/scopus.csv",
-        combined_data,
+MERGE_ORDER = ["pubmed", "cinahl", "medline", "psycinfo", "embase", "scopus"]
+MERGED_PATH = "outputs/basic-processing/merged-abstracts.csv"
+MERGED_KEYS_PATH = "outputs/basic-processing/merged-keys"
+
+
+def merge_step_keys():
+    # Each step's key covers its source and, through the chain, every earlier
+    # step.
+    keys = []
+    key = None
+    for name in MERGE_ORDER:
+        key = stage_cache.stage_key(
+            f"merge {name}",
+            files=[intermediate.read_path(f"outputs/basic-processing/{name}")],
+            code=[__file__, dedup_keys.__file__, intermediate.__file__],
+            config=intermediate.intermediate_format(),
+            parent=key,
+        )
+        keys.append(key)
+    return keys
+
+
+def merge_sources(cache=None, store=None):
+    # Returns the DedupIndex of all merged sources and the number of records
+    # from PubMed. With a cache, resumes after the last unchanged step. With
+    # a RecordStore, writes each source's merge decisions to it.
+    index = DedupIndex()
+    pubmed_length = None
+    start = 0
+    keys = merge_step_keys() if cache is not None else []
+    for i in reversed(range(len(keys))):
+        if cache.has(keys[i]):
+            print(f"Restored merge up to {MERGE_ORDER[i]} from cache")
+            stem = os.path.splitext(cache.cached_file(keys[i], 0))[0]
+            index = DedupIndex.from_frame(intermediate.read_frame(stem))
+            pubmed_length = cache.touch(keys[i])
+            start = i + 1
+            break
+
+    profiler = Profiler("merge")
+    abstracts = NormalisedAbstracts()
+    # The next source is read while this one is merged. Only this thread
+    # uses the profiler, so its read stage times the wait for the source
+    # (see overlap.py) and no two stages overlap.
+    frames = prefetch(
+        intermediate.read_frame(f"outputs/basic-processing/{name}")
+        for name in MERGE_ORDER[start:]
     )
+    for i, name in enumerate(MERGE_ORDER[start:], start):
+        with profiler.stage("merge: read", source=name) as stage:
+            data = next(frames)
+            stage["rows_out"] = len(data)
+        print(f"\nMerging {name}")
+        merge_frame(name, data, index, profiler, abstracts, store)
+        if name == "pubmed":
+            # All of PubMed's records, before they were deduplicated.
+            pubmed_length = len(data)
+            print(f"Pubmed: {pubmed_length}")
+        if cache is not None:
+            with tempfile.TemporaryDirectory() as tmp:
+                intermediate.write_frame(index.merged(), f"{tmp}/merged")
+                cache.store(
+                    keys[i],
+                    f"merge {name}",
+                    [intermediate.path(f"{tmp}/merged")],
+                    pubmed_length,
+                )
+    abstracts.save(prune=start == 0)
+    profiler.write(profiling.profile_path("merge"))
+    return index, pubmed_length
 
-    combined_data.set_index("dedup_index", inplace=True)
 
-    # Drop some dupes manually discovered by inspecting articles with identical titles
-    manual_dupes = [
-        "fetalheartrateabnormalitiesduringandafterexternalcephalicversion:whichfetusesareatriskandhowaretheydelivered?;2018;kuppens",
-        "stress,sleepqualityandunplannedcaesareansectioninpregnantwomen;2017;yi-li",
-        "combinedlaparoscopyandhysteroscopyvs.uterinecurettageintheuterinearteryembolization-basedmanagementofcesareanscarpregnancy:acohortstudy;2014;xue",
-        "revisitingheadcircumferenceofbraziliannewbornsinpublicandprivatematernityhospitals;2017;dosocorroteixeiraamorim",
-        "theshapeofuterinecontractionsandlaborprogressinthespontaneousactivelabor;2015;ebrahimzadehzagami",
-        "thecomparisonofseruminterleukin-6ofmothersinvaginalandelectivecesareandelivery;2014;mojaveri",
-        "methadonedoseasadeterminantofinfantoutcomeduringtheperiandpostnatalperiod;2018;mei",
-        "clinicalassociationofserumcalciumlevelsinpre-eclampsiaandgestationalhypertensionpatients:aprospectiveobservationalstudy;2019;lakshmikanthamma",
-        "evaluationofpostplacentaltranscaesarean/vaginaldeliveryintrauterinedevice(ppiucd)intermsofawareness,acceptanceandexpulsioninserviceshospital,lahore;2016;tariq",
-        "theincidenceandriskfactorsofsurgicalwoundinfectionafterabdominalhysterectomyincancerouswomen;2021;mahdavi",
-        "preferredmodeofdeliveryiniraqiprimiparouswomen;2021;salihal-asadi",
-        "evaluationoftheanalgesicefficacyofmelatonininpatientsundergoingcesareansectionunderspinalanesthesia:aprospectiverandomizeddouble-blindstudy;2016;khezri",
-        "employment-relatedphysicalactivityduringpregnancy:birthweightandstillbirthdeliveryinkarachi,pakistan;2022;alirizvi",
-        "comparisonofintrathecallow-doselevobupivacainewithlevobupivacaine-fentanylandlevobupivacaine-sufentanilcombinationsforcesareansection;2019;sahin",
-        "previousexposuretoanesthesiaandautismspectrumdisorder(asd):apuertoricanpopulation-basedsiblingcohortstudy;2015;creagh",
-        "implementationofclinicalpathwaysinmalaysia:canclinicalpathwaysimprovethequalityofcare?;2016;i.",
-        "double-ballooncathetercomparedtovaginaldinoprostoneforcervicalripeninginobesewomenatterm;[comparaisonsondeadoubleballonnet-dinoprostonepourlamaturationcervicalechezlesfemmesobesesaterme];2018;grange",
-        "menstrualpatternfollowingtuballigation:ahistoricalcohortstudy;2016;sadatmahalleh",
-        "predictorsformoderatetosevereacutepostoperativepainaftercesareansection;2016;decarvalhoborges",
-        "managementofbreechpresentationatterm:aretrospectivecohortstudyof10yearsofexperience;2016;rodriguez",
-        "racialdisparityinpostpartumreadmissionduetohypertensionamongwomenwithpregnancy-associatedhypertension;2020;chornock",
-        "portablerespiratorypolygraphymonitoringofobesemothersthefirstnightaftercaesareansectionwithbupivacaine/morphine/fentanylspinalanaesthesia;2017;hein",
-        "women'spelvicfloormusclestrengthandurinaryandanalincontinenceafterchildbirth:across-sectionalstudy;2017;priscilatavares",
-        "pregnancy,parturition,parityandpositioninthefamily.anyinfluenceonthedevelopmentofpaediatricinguinalhernia/hydrocele?;2014;irabor",
-        "relationshipbetweengestationalriskandtypeofdeliveryinhighriskpregnancy;2020;benattiantunes",
+# Drop some dupes manually discovered by inspecting articles with identical titles
+MANUAL_DUPLICATES = [
+    "fetalheartrateabnormalitiesduringandafterexternalcephalicversion:whichfetusesareatriskandhowaretheydelivered?;2018;kuppens",
+    "stress,sleepqualityandunplannedcaesareansectioninpregnantwomen;2017;yi-li",
+    "combinedlaparoscopyandhysteroscopyvs.uterinecurettageintheuterinearteryembolization-basedmanagementofcesareanscarpregnancy:acohortstudy;2014;xue",
+    "revisitingheadcircumferenceofbraziliannewbornsinpublicandprivatematernityhospitals;2017;dosocorroteixeiraamorim",
+    "theshapeofuterinecontractionsandlaborprogressinthespontaneousactivelabor;2015;ebrahimzadehzagami",
+    "thecomparisonofseruminterleukin-6ofmothersinvaginalandelectivecesareandelivery;2014;mojaveri",
+    "methadonedoseasadeterminantofinfantoutcomeduringtheperiandpostnatalperiod;2018;mei",
+    "clinicalassociationofserumcalciumlevelsinpre-eclampsiaandgestationalhypertensionpatients:aprospectiveobservationalstudy;2019;lakshmikanthamma",
+    "evaluationofpostplacentaltranscaesarean/vaginaldeliveryintrauterinedevice(ppiucd)intermsofawareness,acceptanceandexpulsioninserviceshospital,lahore;2016;tariq",
+    "theincidenceandriskfactorsofsurgicalwoundinfectionafterabdominalhysterectomyincancerouswomen;2021;mahdavi",
+    "preferredmodeofdeliveryiniraqiprimiparouswomen;2021;salihal-asadi",
+    "evaluationoftheanalgesicefficacyofmelatonininpatientsundergoingcesareansectionunderspinalanesthesia:aprospectiverandomizeddouble-blindstudy;2016;khezri",
+    "employment-relatedphysicalactivityduringpregnancy:birthweightandstillbirthdeliveryinkarachi,pakistan;2022;alirizvi",
+    "comparisonofintrathecallow-doselevobupivacainewithlevobupivacaine-fentanylandlevobupivacaine-sufentanilcombinationsforcesareansection;2019;sahin",
+    "previousexposuretoanesthesiaandautismspectrumdisorder(asd):apuertoricanpopulation-basedsiblingcohortstudy;2015;creagh",
+    "implementationofclinicalpathwaysinmalaysia:canclinicalpathwaysimprovethequalityofcare?;2016;i.",
+    "double-ballooncathetercomparedtovaginaldinoprostoneforcervicalripeninginobesewomenatterm;[comparaisonsondeadoubleballonnet-dinoprostonepourlamaturationcervicalechezlesfemmesobesesaterme];2018;grange",
+    "menstrualpatternfollowingtuballigation:ahistoricalcohortstudy;2016;sadatmahalleh",
+    "predictorsformoderatetosevereacutepostoperativepainaftercesareansection;2016;decarvalhoborges",
+    "managementofbreechpresentationatterm:aretrospectivecohortstudyof10yearsofexperience;2016;rodriguez",
+    "racialdisparityinpostpartumreadmissionduetohypertensionamongwomenwithpregnancy-associatedhypertension;2020;chornock",
+    "portablerespiratorypolygraphymonitoringofobesemothersthefirstnightaftercaesareansectionwithbupivacaine/morphine/fentanylspinalanaesthesia;2017;hein",
+    "women'spelvicfloormusclestrengthandurinaryandanalincontinenceafterchildbirth:across-sectionalstudy;2017;priscilatavares",
+    "pregnancy,parturition,parityandpositioninthefamily.anyinfluenceonthedevelopmentofpaediatricinguinalhernia/hydrocele?;2014;irabor",
+    "relationshipbetweengestationalriskandtypeofdeliveryinhighriskpregnancy;2020;benattiantunes",
+]
+
+
+def main(cache=None):
+    store = record_store.open_store()
+    index, pubmed_length = merge_sources(cache, store)
+    combined_data = index.merged()
+    # The keys of every merged record, including the manual duplicates
+    # dropped below, which later records were checked against (see delta.py).
+    # Tables are written in the background while the next steps run.
+    writes = [
+        background(
+            intermediate.write_frame, combined_data[["source"] + DEDUP_KEYS], MERGED_KEYS_PATH
+        )
     ]
+    combined_data.set_index("dedup_index", inplace=True)
 
     l = len(combined_data)
-    combined_data = combined_data.drop(index=manual_dupes)
+    manual = numpy.array(MANUAL_DUPLICATES, dtype=object)
+    merged = index.keys["dedup_index"].contains(pandas.Series(manual))
+    for key in manual[~merged]:
+        print(f"Manual duplicate {key} is not among the merged records")
+    combined_data = combined_data.drop(index=manual[merged])
+    if store is not None:
+        store.mark_merged(manual[merged], "manual duplicate")
+        store.close()
 
     title_vc = combined_data["title"].value_counts()
     print(title_vc[title_vc > 1])
 
-    combined_data.to_csv("outputs/basic-processing/merged-abstracts.csv")
+    writes.append(background(combined_data.to_csv, MERGED_PATH))
     print(f"Removed {l - len(combined_data)} manually identified duplicates, now {len(combined_data)}")
     print(
-        f"Found {len(combined_data) - len(pubmed_data)} additional records from non-PubMed sources"
+        f"Found {len(combined_data) - pubmed_length} additional records from non-PubMed sources"
     )
 
+    # Near-duplicates that exact matching missed, for review.
+    near_duplicates.write_review(combined_data)
+    for write in writes:
+        write.result()
+
 
 if __name__ == "__main__":
     sys.exit(main())
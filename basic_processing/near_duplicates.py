@@ -0,0 +1,286 @@
+# Finds near-duplicate records in the merged corpus, i.e. records that exact
+# matching on dedup_index and lower_abstract misses because of small spelling,
+# transliteration or author-format differences.
+#
+# Each record's normalised title and abstract are broken into word shingles
+# and summarised by a MinHash signature. Locality-sensitive hashing over bands
+# of the signatures proposes candidate pairs in near-linear time, and pairs
+# whose estimated Jaccard similarity reaches the threshold are grouped into
+# clusters, which are written to a review sheet.
+#
+# Usage: python basic_processing/near_duplicates.py [--threshold T]
+#            [--num-perm N] [--bands B] [--shingle-size K] [--drop]
+
+import argparse
+import sys
+
+import numpy
+import pandas
+
+MAX_HASH = (1 << 32) - 1
+# Buckets larger than this are only compared against their first record, so
+# a very common band value cannot make the comparison quadratic.
+MAX_BUCKET_PAIRS = 100
+
+REVIEW_PATH = "outputs/basic-processing/near-duplicates.xlsx"
+REVIEW_COLUMNS = [
+    "dedup_index",
+    "title",
+    "year",
+    "first_author_surname",
+    "source",
+    "pmid",
+    "doi",
+]
+
+
+# Texts are tokenised CHUNK_SIZE at a time, as arrays over their UTF-8
+# bytes rather than with per-record string operations.
+CHUNK_SIZE = 10000
+
+# Maps each byte to its lower case, or to 0 if it separates words. Bytes of
+# multi-byte characters are kept as part of words.
+WORD_BYTES = numpy.zeros(256, dtype=numpy.uint8)
+for c in b"abcdefghijklmnopqrstuvwxyz0123456789":
+    WORD_BYTES[c] = c
+for c in b"ABCDEFGHIJKLMNOPQRSTUVWXYZ":
+    WORD_BYTES[c] = c + 32
+WORD_BYTES[128:] = numpy.arange(128, 256)
+# Powers of a multiplier for hashing each byte by its position in a word.
+BYTE_WEIGHTS = numpy.cumprod(numpy.full(256, 1000003, dtype=numpy.uint64))
+
+
+def texts(df):
+    text = df["title"].fillna("") + " " + df["abstract"].fillna("")
+    # NUL separates texts in word_hashes.
+    return text.str.replace("\0", " ", regex=False)
+
+
+def word_hashes(text):
+    # Returns (record, word hash) arrays for the words of each text, in order.
+    data = numpy.frombuffer(("\0".join(text) + "\0").encode("utf-8"), dtype=numpy.uint8)
+    lower = WORD_BYTES[data]
+    in_word = lower != 0
+    edges = numpy.diff(in_word.view(numpy.int8), prepend=0, append=0)
+    starts = numpy.flatnonzero(edges == 1)
+    lengths = numpy.flatnonzero(edges == -1) - starts
+    firsts = numpy.cumsum(lengths) - lengths
+
+    chars = lower[in_word].astype(numpy.uint64)
+    offsets = numpy.arange(len(chars)) - numpy.repeat(firsts, lengths)
+    with numpy.errstate(over="ignore"):
+        chars *= BYTE_WEIGHTS[numpy.minimum(offsets, len(BYTE_WEIGHTS) - 1)]
+    hashes = numpy.add.reduceat(chars, firsts) if len(firsts) else chars
+    return numpy.searchsorted(numpy.flatnonzero(data == 0), starts), hashes
+
+
+def shingles(text, shingle_size):
+    # Returns (record, shingle id) arrays for the word shingles of each text.
+    # Texts shorter than shingle_size words get a single shingle.
+    record, codes = word_hashes(text)
+
+    # Shingle i of a record combines words i..i+k-1, as long as they all
+    # belong to the same record.
+    n = len(codes)
+    shingle = numpy.zeros(n, dtype=numpy.uint64)
+    valid = numpy.ones(n, dtype=bool)
+    for j in range(shingle_size):
+        shifted = numpy.zeros(n, dtype=numpy.uint64)
+        shifted[: n - j] = codes[j:]
+        same_record = numpy.zeros(n, dtype=bool)
+        same_record[: n - j] = record[j:] == record[: n - j]
+        valid &= same_record
+        # Words past the end of the record are left out, so that the shingle
+        # of a short text has only its own words.
+        shifted[~same_record] = 0
+        with numpy.errstate(over="ignore"):
+            shingle = shingle * numpy.uint64(1000003) + shifted
+
+    # Keep texts too short for a full shingle, using the shingle of all their
+    # words.
+    counts = numpy.bincount(record, minlength=len(text))
+    short = counts[record] < shingle_size
+    first = numpy.r_[True, record[1:] != record[:-1]]
+    keep = valid | (short & first)
+    return record[keep], shingle[keep]
+
+
+def hash_functions(num_perm, seed=1):
+    # Random odd multipliers and offsets for multiply-shift hashing.
+    rng = numpy.random.default_rng(seed)
+    a = rng.integers(0, 1 << 63, size=num_perm, dtype=numpy.uint64) * numpy.uint64(2) + numpy.uint64(1)
+    b = rng.integers(0, 1 << 63, size=num_perm, dtype=numpy.uint64)
+    return a, b
+
+
+def minhash_signatures(records, shingle_ids, n_records, a, b):
+    # MinHash signature of each record, the minimum over its shingles of
+    # each hash function. Records without shingles get MAX_HASH. records is
+    # in ascending order, as shingles returns it.
+    signatures = numpy.full((n_records, len(a)), MAX_HASH, dtype=numpy.uint32)
+    if len(records) == 0:
+        return signatures
+    starts = numpy.flatnonzero(numpy.r_[True, records[1:] != records[:-1]])
+    h = numpy.empty(len(shingle_ids), dtype=numpy.uint64)
+    with numpy.errstate(over="ignore"):
+        for i in range(len(a)):
+            numpy.multiply(shingle_ids, a[i], out=h)
+            h += b[i]
+            h >>= numpy.uint64(32)
+            signatures[records[starts], i] = numpy.minimum.reduceat(h, starts)
+    return signatures
+
+
+def text_signatures(text, num_perm, shingle_size):
+    # Returns the MinHash signature of each text and whether it had any
+    # words.
+    a, b = hash_functions(num_perm)
+    signatures = numpy.empty((len(text), num_perm), dtype=numpy.uint32)
+    has_words = numpy.zeros(len(text), dtype=bool)
+    for start in range(0, len(text), CHUNK_SIZE):
+        chunk = text[start : start + CHUNK_SIZE]
+        records, shingle_ids = shingles(chunk, shingle_size)
+        signatures[start : start + len(chunk)] = minhash_signatures(
+            records, shingle_ids, len(chunk), a, b
+        )
+        has_words[start + records] = True
+    return signatures, has_words
+
+
+def candidate_pairs(signatures, bands):
+    rows = signatures.shape[1] // bands
+    pairs = set()
+    for band in range(bands):
+        part = pandas.DataFrame(signatures[:, band * rows : (band + 1) * rows])
+        keys = pandas.util.hash_pandas_object(part, index=False).to_numpy()
+        buckets = pandas.Series(numpy.arange(len(keys))).groupby(keys)
+        for members in buckets.indices.values():
+            if len(members) < 2:
+                continue
+            if len(members) * (len(members) - 1) // 2 > MAX_BUCKET_PAIRS:
+                pairs.update((members[0], m) for m in members[1:])
+                continue
+            for i in range(len(members)):
+                for j in range(i + 1, len(members)):
+                    pairs.add((members[i], members[j]))
+    return pairs
+
+
+def find_root(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def find_clusters(df, threshold=0.8, num_perm=128, bands=16, shingle_size=3):
+    # Returns a DataFrame with the position of each clustered record in df,
+    # its cluster number and its estimated similarity to the first record of
+    # the cluster.
+    if num_perm % bands != 0:
+        raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+    df = df.reset_index(drop=True)
+    # Records with the same text share a signature, computed once.
+    codes, distinct = pandas.factorize(texts(df))
+    signatures, has_words = text_signatures(distinct, num_perm, shingle_size)
+    signatures = signatures[codes]
+    has_shingles = has_words[codes]
+
+    parent = list(range(len(df)))
+    for i, j in candidate_pairs(signatures, bands):
+        if not (has_shingles[i] and has_shingles[j]):
+            continue
+        if numpy.mean(signatures[i] == signatures[j]) >= threshold:
+            ri, rj = find_root(parent, i), find_root(parent, j)
+            if ri != rj:
+                parent[max(ri, rj)] = min(ri, rj)
+
+    roots = numpy.array([find_root(parent, i) for i in range(len(df))])
+    sizes = numpy.bincount(roots, minlength=len(df))
+    positions = numpy.flatnonzero(sizes[roots] > 1)
+    clusters = pandas.DataFrame(
+        {
+            "position": positions,
+            "root": roots[positions],
+            "similarity": [
+                numpy.mean(signatures[p] == signatures[roots[p]]) for p in positions
+            ],
+        }
+    )
+    clusters["cluster"] = pandas.factorize(clusters["root"])[0] + 1
+    return clusters.drop(columns="root").sort_values(["cluster", "position"])
+
+
+def review_sheet(df, clusters):
+    df = df.reset_index()
+    columns = [c for c in REVIEW_COLUMNS if c in df.columns]
+    sheet = df.iloc[clusters["position"]][columns].reset_index(drop=True)
+    sheet.insert(0, "cluster", clusters["cluster"].to_numpy())
+    sheet.insert(1, "similarity", clusters["similarity"].round(3).to_numpy())
+    return sheet
+
+
+def drop_near_duplicates(df, clusters):
+    # Keeps the first record of each cluster.
+    later = clusters[clusters["cluster"].duplicated()]["position"]
+    keep = numpy.ones(len(df), dtype=bool)
+    keep[later.to_numpy()] = False
+    return df[keep]
+
+
+def write_review(df, path=REVIEW_PATH, **config):
+    # Finds clusters of near-duplicates in df and writes them to a review
+    # sheet at path. config is passed on to find_clusters.
+    clusters = find_clusters(df, **config)
+    print(
+        f"Found {clusters['cluster'].nunique()} clusters of near-duplicates "
+        f"covering {len(clusters)} of {len(df)} records"
+    )
+    review_sheet(df, clusters).to_excel(path, sheet_name="near-duplicates", index=False)
+    return clusters
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="outputs/basic-processing/merged-abstracts.csv")
+    parser.add_argument("--output", default=REVIEW_PATH)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.8,
+        help="minimum estimated Jaccard similarity of a duplicate pair",
+    )
+    parser.add_argument("--num-perm", type=int, default=128, help="MinHash signature length")
+    parser.add_argument(
+        "--bands",
+        type=int,
+        default=16,
+        help="LSH bands; more bands find more candidates at lower similarity",
+    )
+    parser.add_argument("--shingle-size", type=int, default=3, help="words per shingle")
+    parser.add_argument(
+        "--drop",
+        action="store_true",
+        help="also write the input without all but the first record of each cluster",
+    )
+    args = parser.parse_args()
+
+    df = pandas.read_csv(args.input, index_col="dedup_index")
+    clusters = write_review(
+        df,
+        args.output,
+        threshold=args.threshold,
+        num_perm=args.num_perm,
+        bands=args.bands,
+        shingle_size=args.shingle_size,
+    )
+
+    if args.drop:
+        deduplicated = drop_near_duplicates(df, clusters)
+        path = args.input.replace(".csv", "-near-deduplicated.csv")
+        deduplicated.to_csv(path)
+        print(f"Removed {len(df) - len(deduplicated)} near-duplicates, now {len(deduplicated)}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
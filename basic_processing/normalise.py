@@ -0,0 +1,138 @@
+# Vectorised normalisation of titles, authors and abstracts, applied to whole
+# columns at once rather than row by row.
+
+from functools import lru_cache
+import time
+
+import numpy
+import pandas
+from unidecode import unidecode
+
+LINE_BREAKS = r"[\r\n]+"  # Any run of \r\n, \r or \n
+NON_ASCII = r"[^\x00-\x7f]+"
+
+
+@lru_cache(maxsize=1 << 16)
+def cached_unidecode(s):
+    return unidecode(s)
+
+
+def replace_where(s, mask, f):
+    # Applies f only to the values selected by mask.
+    if not mask.any():
+        return s
+    s = s.copy()
+    s[mask] = f(s[mask])
+    return s
+
+
+def transliterate(s):
+    # unidecode maps each character independently and leaves ASCII unchanged,
+    # so only runs of non-ASCII characters are transliterated, once per
+    # distinct run.
+    non_ascii = s.notna() & ~s.map(str.isascii, na_action="ignore").eq(True)
+    return replace_where(
+        s,
+        non_ascii,
+        lambda t: t.str.replace(NON_ASCII, lambda m: cached_unidecode(m.group(0)), regex=True),
+    )
+
+
+def tidy_titles(titles):
+    titles = titles.str.replace(r"\s+", " ", regex=True).str.lower().str.strip()
+    titles = transliterate(titles)
+    # Remove one surrounding quote and one trailing full stop.
+    titles = titles.str.removeprefix('"').str.removesuffix('"')
+    return titles.str.removesuffix(".")
+
+
+def remove_line_breaks(s):
+    has_break = s.str.contains("\n", regex=False, na=False) | s.str.contains(
+        "\r", regex=False, na=False
+    )
+    return replace_where(s, has_break, lambda t: t.str.replace(LINE_BREAKS, ";", regex=True))
+
+
+def tidy_author_names(names):
+    # Adds a comma at the last space of each name, unless there is one there
+    # already. Names without a space get one before their last character.
+    parts = names.str.extract(r"(?s)^(.*) ([^ ]*)$")
+    has_space = parts[0].notna()
+    spaced = parts[0].where(parts[0].str.endswith(","), parts[0] + ",") + " " + parts[1]
+    unspaced = names.where(names.str[-2:-1] == ",", names.str[:-1] + "," + names.str[-1:])
+    return spaced.where(has_space, unspaced)
+
+
+def tidy_author_lists(authors, sep=";"):
+    authors = transliterate(remove_line_breaks(authors))
+    present = authors.notna().to_numpy()
+    lists = authors[present].reset_index(drop=True)
+    names = lists.str.split(sep, regex=False).explode().str.strip()
+    names = names[names.str.len() > 0]
+    # The same authors appear on many records, so each distinct name is
+    # tidied once.
+    distinct = pandas.Series(names.unique())
+    names = names.map(dict(zip(distinct, tidy_author_names(distinct))))
+    # explode keeps each record's names contiguous and in order.
+    starts = numpy.searchsorted(names.index.to_numpy(), numpy.arange(len(lists)))
+    groups = numpy.split(names.to_numpy(), starts[1:])
+    result = authors.copy()
+    result[present] = [";".join(g) for g in groups]
+    return result
+
+
+def first_author_surnames(authors):
+    # Assumes tidy_author_lists had been run first.
+    return authors.str.extract(r"^([^;,]*)", expand=False)
+
+
+def tidy_abstracts(abstracts):
+    return transliterate(remove_line_breaks(abstracts))
+
+
+def format_years(years):
+    formats = {y: f"{y:.0f}" for y in years.dropna().unique()}
+    return years.map(formats).fillna("nan")
+
+
+def dedup_indexes(df):
+    s = (
+        df["title"].str.strip()
+        + ";"
+        + format_years(df["year"])
+        + ";"
+        + df["first_author_surname"].astype(str)
+    )
+    return s.str.lower().str.replace(r"\s+", "", regex=True)
+
+
+def normalise(df, sep=";"):
+    # Normalises the text columns of df in place and adds first_author_surname
+    # and dedup_index. Returns the time taken by each step.
+    timings = {}
+    start = time.perf_counter()
+
+    def lap(name):
+        nonlocal start
+        now = time.perf_counter()
+        timings[name] = now - start
+        start = now
+
+    df["title"] = tidy_titles(df["title"])
+    lap("title")
+    df["authors"] = tidy_author_lists(df["authors"], sep)
+    lap("authors")
+    df["first_author_surname"] = first_author_surnames(df["authors"])
+    lap("first author surname")
+    df["abstract"] = tidy_abstracts(df["abstract"])
+    lap("abstract")
+    df["dedup_index"] = dedup_indexes(df)
+    lap("dedup index")
+    return timings
+
+
+def print_timings(timings):
+    print("Normalisation timings:")
+    for name, t in timings.items():
+        print(f"  {name}: {t:.3f}s")
+    print(f"  total: {sum(timings.values()):.3f}s")
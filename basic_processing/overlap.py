@@ -0,0 +1,105 @@
+# Overlaps the stages of a script, so that e.g. the next input is read and
+# the current one filtered while the previous output is written.
+#
+# prefetch() produces an iterable's items on a separate thread, at most
+# QUEUE_SIZE ahead of the thread consuming them. The bounded queue applies
+# backpressure: a producer that gets ahead waits for the consumer, so only a
+# few items (input files, chunks or frames) are held in memory at once.
+# Stages overlap where they release the GIL, as file reads and writes, Parquet
+# encoding and compression and much of pandas' and numpy's work do; stages
+# that run Python code take turns, so on a single CPU the stages run one
+# after another as before. Set PIPELINE_THREADS=0 to always run them in turn
+# (e.g. to profile them separately), or 1 to always overlap them. They always
+# run in turn with PROFILE_TRACEMALLOC=1, as tracemalloc has one peak for the
+# whole process (see profiling.py).
+#
+# background() starts a single task, such as writing a finished table, while
+# the script moves on.
+
+import concurrent.futures
+import os
+import queue
+import threading
+
+# Items produced ahead of the consumer.
+QUEUE_SIZE = 2
+# How often a producer waiting on a full queue checks whether to stop.
+POLL_SECONDS = 0.1
+
+DONE = object()
+
+
+def enabled():
+    if os.environ.get("PROFILE_TRACEMALLOC") == "1":
+        return False
+    setting = os.environ.get("PIPELINE_THREADS")
+    if setting is None:
+        return (os.cpu_count() or 1) > 1
+    return setting != "0"
+
+
+def prefetch(items, size=QUEUE_SIZE):
+    # Yields the items of the iterable items, produced by another thread.
+    # An exception raised while producing them is raised here, and the
+    # producer stops when the consumer does.
+    if not enabled():
+        yield from items
+        return
+    entries = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                entries.put(entry, timeout=POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+        except BaseException as e:
+            put((DONE, e))
+            return
+        finally:
+            # e.g. closes the files of a generator the consumer gave up on.
+            close = getattr(items, "close", None)
+            if close is not None:
+                close()
+        put((DONE, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = entries.get()
+            if item is DONE:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def background(function, *args):
+    # Runs function(*args) on another thread. Returns a Future, whose
+    # result() waits for it to finish and raises any exception it raised.
+    future = concurrent.futures.Future()
+
+    def run():
+        try:
+            future.set_result(function(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    if enabled():
+        threading.Thread(target=run).start()
+    else:
+        run()
+    return future
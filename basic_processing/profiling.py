@@ -0,0 +1,118 @@
+# Records the wall time, rows in and out and memory of each stage of a run,
+# and writes them as JSON lines.
+#
+# Peak RSS is always recorded. Set PROFILE_TRACEMALLOC=1 to also record the
+# peak Python allocation within each stage (this slows the run down), and
+# PROFILE_STAGE=<stage> to run every call of one stage, e.g. "normalise" or
+# "rules: title", under cProfile. The profile is saved next to the records,
+# and its top functions are printed.
+
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PROFILE_DIR = "outputs/basic-processing/profile"
+# Settings that make a run profile more than the defaults (PROFILE_RULES is
+# read by basic_processing.process).
+SETTINGS = ["PROFILE_RULES", "PROFILE_TRACEMALLOC", "PROFILE_STAGE"]
+
+
+def profile_path(name):
+    return f"{PROFILE_DIR}/{name}.jsonl"
+
+
+def requested():
+    # Whether any of SETTINGS is set, so that the stages should be run rather
+    # than restored with the profile of an earlier run.
+    return any(os.environ.get(s) for s in SETTINGS)
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere.
+    return rss / 1024**2 if sys.platform == "darwin" else rss / 1024
+
+
+class Profiler:
+    def __init__(self, source):
+        self.source = source
+        # (source, stage) to its record, in the order stages were first seen.
+        # Stages run more than once (e.g. per chunk) are added together.
+        self.records = {}
+        self.trace = os.environ.get("PROFILE_TRACEMALLOC") == "1"
+        self.profile_stage = os.environ.get("PROFILE_STAGE")
+        self.cprofile = None
+
+    def add(self, stage, seconds=None, rows_in=None, rows_out=None, memory=None, source=None):
+        source = source or self.source
+        record = self.records.setdefault(
+            (source, stage), {"source": source, "stage": stage, "seconds": None, "calls": 0}
+        )
+        record["calls"] += 1
+        if seconds is not None:
+            record["seconds"] = (record["seconds"] or 0) + seconds
+        for key, n in [("rows_in", rows_in), ("rows_out", rows_out)]:
+            if n is not None:
+                record[key] = record.get(key, 0) + int(n)
+        record["peak_rss_mb"] = peak_rss_mb()
+        if memory is not None:
+            record["tracemalloc_peak_mb"] = max(record.get("tracemalloc_peak_mb", 0), memory)
+        return record
+
+    @contextlib.contextmanager
+    def stage(self, stage, rows_in=None, source=None):
+        # Times the body; set "rows_out" in the yielded dict to record it.
+        # Stages should not be nested, as tracemalloc has one peak.
+        out = {}
+        if self.trace:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        profiling = stage == self.profile_stage
+        if profiling:
+            self.cprofile = self.cprofile or cProfile.Profile()
+            self.cprofile.enable()
+        start = time.perf_counter()
+        try:
+            yield out
+        finally:
+            seconds = time.perf_counter() - start
+            if profiling:
+                self.cprofile.disable()
+            memory = None
+            if self.trace:
+                memory = (tracemalloc.get_traced_memory()[1] - base) / 1024**2
+            self.add(stage, seconds, rows_in, out.get("rows_out"), memory, source)
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            for record in self.records.values():
+                f.write(json.dumps(record) + "\n")
+        if self.cprofile is not None:
+            stats_path = os.path.splitext(path)[0] + ".prof"
+            self.cprofile.dump_stats(stats_path)
+            print(f"Profile of {self.profile_stage} saved to {stats_path}")
+            pstats.Stats(self.cprofile).sort_stats("cumulative").print_stats(15)
+
+
+def concatenate(paths, path):
+    # Joins the records of several runs into one file.
+    with open(path, "w") as out:
+        for p in paths:
+            if os.path.exists(p):
+                with open(p) as f:
+                    out.write(f.read())
@@ -0,0 +1,225 @@
+# An optional SQLite store of every record, what basic processing decided
+# about it and what merging decided about it, so that questions such as
+# "which rule excluded pmid X" or "is this doi already merged" are answered by
+# an index lookup rather than by loading the outputs into pandas.
+#
+# Set RECORD_STORE to the path of the database (or run pipeline.py with
+# --record-store PATH) and basic processing and merging also write to it, a
+# chunk or a source at a time, each in one transaction. Each source's rows
+# are replaced whenever it is processed or merged again. Tables:
+#
+#   records: every parsed record of each source (by its row in the parsed
+#     export), with its dedup index and basic processing decision ("kept",
+#     "prefilter", "duplicate" or the name of the rule that excluded it).
+#   merge_decisions: every processed record (by its row in the processed
+#     output), with the hash of its normalised abstract and whether it was
+#     merged or which key it duplicated.
+#
+# Both are indexed on pmid, doi and dedup index, and merge_decisions on the
+# abstract hash too.
+#
+# Usage: python basic_processing/record_store.py [--path PATH]
+#            {pmid,doi,dedup_index,abstract_hash} VALUE
+#        python basic_processing/record_store.py [--path PATH] sql QUERY
+
+import argparse
+import os
+import sqlite3
+import sys
+
+import pandas
+
+import intermediate
+
+# Seconds a writer waits for another (e.g. processing another source in
+# parallel) to finish its transaction.
+BUSY_TIMEOUT = 600
+# Page cache per connection, in KiB, so that bulk inserts update the indexes
+# in memory.
+CACHE_KIB = 256 * 1024
+
+# Parsed columns kept for each record, and their names in the store.
+RECORD_COLUMNS = {
+    "pmid": "pmid",
+    "doi": "doi",
+    "title": "title",
+    "year": "year",
+    "authors": "authors",
+    "abstract": "abstract",
+    "journal": "journal",
+    "language": "language",
+    "publication types": "publication_types",
+}
+KEYS = ["pmid", "doi", "dedup_index"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    source TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    pmid TEXT,
+    doi TEXT,
+    dedup_index TEXT,
+    title TEXT,
+    year REAL,
+    authors TEXT,
+    abstract TEXT,
+    journal TEXT,
+    language TEXT,
+    publication_types TEXT,
+    decision TEXT NOT NULL,
+    PRIMARY KEY (source, row)
+);
+CREATE TABLE IF NOT EXISTS merge_decisions (
+    source TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    pmid TEXT,
+    doi TEXT,
+    dedup_index TEXT,
+    abstract_hash TEXT,
+    decision TEXT NOT NULL,
+    PRIMARY KEY (source, row)
+);
+CREATE INDEX IF NOT EXISTS records_pmid ON records (pmid);
+CREATE INDEX IF NOT EXISTS records_doi ON records (doi);
+CREATE INDEX IF NOT EXISTS records_dedup_index ON records (dedup_index);
+CREATE INDEX IF NOT EXISTS merge_decisions_pmid ON merge_decisions (pmid);
+CREATE INDEX IF NOT EXISTS merge_decisions_doi ON merge_decisions (doi);
+CREATE INDEX IF NOT EXISTS merge_decisions_dedup_index ON merge_decisions (dedup_index);
+CREATE INDEX IF NOT EXISTS merge_decisions_abstract_hash ON merge_decisions (abstract_hash);
+"""
+
+
+def store_path():
+    return os.environ.get("RECORD_STORE") or None
+
+
+def strings(values):
+    return values.map(intermediate.tidy_string).astype(object)
+
+
+def numbers(values):
+    values = pandas.to_numeric(values, errors="coerce").astype(object)
+    return values.where(values.notna(), None)
+
+
+def column(df, c):
+    # A column of df as values SQLite accepts, with nulls as None.
+    if c not in df.columns:
+        return [None] * len(df)
+    if c == "year":
+        return numbers(df[c])
+    return strings(df[c])
+
+
+class RecordStore:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Processing writes from the thread that produces its chunks (see
+        # overlap.py), not the one that opened the store; the writes never
+        # overlap.
+        self.connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        # Readers are not blocked by a writer, nor writers by readers. The
+        # store can be rebuilt from the outputs, so a commit need not wait
+        # for the disk (it is still atomic).
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(f"PRAGMA cache_size=-{CACHE_KIB}")
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def insert(self, table, columns, replace=None):
+        # Inserts rows given as columns of values, in one transaction. replace
+        # is a source whose earlier rows are deleted first.
+        names = list(columns)
+        rows = zip(*columns.values())
+        with self.connection:
+            if replace is not None:
+                self.connection.execute(f"DELETE FROM {table} WHERE source = ?", (replace,))
+            self.connection.executemany(
+                f"INSERT INTO {table} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})",
+                rows,
+            )
+
+    def write_records(self, source, df, keys, first=False):
+        # Adds a chunk of a source's parsed records (df, as read) with their
+        # keys and decisions (see basic_processing.record_keys), replacing
+        # the source's earlier records with the first chunk.
+        columns = {"source": [source] * len(df), "row": df.index.tolist()}
+        for c, name in RECORD_COLUMNS.items():
+            columns[name] = column(df, c)
+        columns["dedup_index"] = strings(keys["dedup_index"])
+        columns["decision"] = keys["decision"].astype(object)
+        self.insert("records", columns, replace=source if first else None)
+
+    def write_merge_decisions(self, source, df, decisions, abstract_hashes):
+        # Replaces a source's merge decisions: its processed records (df, as
+        # read) with what merging decided about each, and the hashes of the
+        # abstracts that were normalised (a Series indexed like df, or
+        # shorter).
+        columns = {"source": [source] * len(df), "row": df.index.tolist()}
+        for k in KEYS:
+            columns[k] = column(df, k)
+        hashes = abstract_hashes.reindex(df.index).astype(object)
+        columns["abstract_hash"] = hashes.where(hashes.notna(), None)
+        columns["decision"] = decisions.reindex(df.index).astype(object)
+        self.insert("merge_decisions", columns, replace=source)
+
+    def mark_merged(self, dedup_indexes, decision):
+        # Sets the decision of the merged records with these dedup indexes,
+        # e.g. the manually identified duplicates.
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE merge_decisions SET decision = ? WHERE dedup_index = ? AND decision = 'merged'",
+                ((decision, d) for d in dedup_indexes),
+            )
+
+    def query(self, sql, parameters=()):
+        return pandas.read_sql_query(sql, self.connection, params=parameters)
+
+    def find(self, key, value):
+        # The records, and the merge decisions, with this value of key.
+        records = None
+        if key in KEYS:
+            records = self.query(
+                f"SELECT source, row, pmid, doi, dedup_index, year, title, decision"
+                f" FROM records WHERE {key} = ?",
+                (value,),
+            )
+        merged = self.query(f"SELECT * FROM merge_decisions WHERE {key} = ?", (value,))
+        return records, merged
+
+
+def open_store():
+    # The store named by RECORD_STORE, or None if it is not set.
+    path = store_path()
+    return None if path is None else RecordStore(path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", default=store_path(), help="default: $RECORD_STORE")
+    parser.add_argument("key", choices=KEYS + ["abstract_hash", "sql"])
+    parser.add_argument("value", help="the value to look up, or an SQL query")
+    args = parser.parse_args()
+    if args.path is None or not os.path.exists(args.path):
+        parser.error("no record store; set RECORD_STORE or give --path")
+
+    store = RecordStore(args.path)
+    with pandas.option_context("display.max_rows", None, "display.width", 200):
+        if args.key == "sql":
+            print(store.query(args.value).to_string(index=False))
+            return
+        records, merged = store.find(args.key, args.value)
+        if records is not None:
+            print("Records:")
+            print(records.to_string(index=False) if len(records) > 0 else "none")
+        print("Merge decisions:")
+        print(merged.to_string(index=False) if len(merged) > 0 else "none")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
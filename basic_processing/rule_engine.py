@@ -0,0 +1,276 @@
+# Compiles a declarative table of exclusion rules so that every record is
+# assigned to the first rule that matches it, checking each distinct value of
+# each field once. The rules themselves are read from a JSON file (see
+# load_rules).
+
+import json
+import re
+import time
+
+import numpy
+import pandas
+
+
+# Fields are checked (and reported in the exclusion workbook) in this order.
+FIELDS = ["publication types", "title", "journal"]
+SHEET_SUFFIXES = {
+    "publication types": "pub-types",
+    "title": "title",
+    "journal": "journal",
+}
+
+
+def excel_sheet_name(s):
+    if len(s) > 31:
+        return s[:31]
+    else:
+        return s
+
+
+class Rule:
+    def __init__(self, name, publication_types=None, title=None, journal=None, summary=None):
+        self.name = name
+        # The rule's row in the summary of each source's counts.
+        self.summary = summary or name
+        self.patterns = {
+            "publication types": publication_types or [],
+            "title": title or [],
+            "journal": journal or [],
+        }
+
+    def __repr__(self):
+        return f"Rule: {self.name}"
+
+    def fields(self):
+        return [f for f in FIELDS if len(self.patterns[f]) > 0]
+
+    def sheet_name(self, field):
+        if len(self.fields()) == 1:
+            return excel_sheet_name(self.name)
+        return excel_sheet_name(f"{self.name}-{SHEET_SUFFIXES[field]}")
+
+
+# Keys a rule may have in a rules file, besides the fields.
+RULE_KEYS = ["name", "summary", "comment"]
+
+
+def rule_from_config(entry, i):
+    # Checks one entry of a rules file, so that a mistake is reported when the
+    # file is loaded rather than as a failed or silently empty match later.
+    where = f"rule {i + 1}"
+    if not isinstance(entry, dict):
+        raise ValueError(f"{where}: expected an object, found {entry!r}")
+    name = entry.get("name")
+    if not isinstance(name, str) or name == "":
+        raise ValueError(f"{where}: missing name")
+    where = f"rule {i + 1} ({name})"
+    unknown = sorted(set(entry) - set(RULE_KEYS) - set(FIELDS))
+    if len(unknown) > 0:
+        raise ValueError(f"{where}: unknown keys {unknown}; expected {RULE_KEYS + FIELDS}")
+    for key in ["summary", "comment"]:
+        if key in entry and not isinstance(entry[key], str):
+            raise ValueError(f"{where}: {key} should be a string")
+    patterns = {}
+    for field in FIELDS:
+        values = entry.get(field, [])
+        if not isinstance(values, list) or not all(isinstance(p, str) and p for p in values):
+            raise ValueError(f"{where}: {field} should be a list of non-empty patterns")
+        for pattern in values:
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                raise ValueError(f"{where}: invalid {field} pattern {pattern!r}: {e}") from e
+        patterns[field] = values
+    if not any(patterns.values()):
+        raise ValueError(f"{where}: no patterns for any of {FIELDS}")
+    return Rule(
+        name,
+        publication_types=patterns["publication types"],
+        title=patterns["title"],
+        journal=patterns["journal"],
+        summary=entry.get("summary"),
+    )
+
+
+def load_rules(path):
+    # The rules in the file at path, in order: {"rules": [{"name": ...,
+    # "summary": ..., "title": [patterns], ...}, ...]}.
+    with open(path, encoding="utf-8") as f:
+        try:
+            config = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"{path}: {e}") from e
+    entries = config.get("rules") if isinstance(config, dict) else None
+    if not isinstance(entries, list) or len(entries) == 0:
+        raise ValueError(f"{path}: expected a non-empty list of rules under \"rules\"")
+    try:
+        rules = [rule_from_config(entry, i) for i, entry in enumerate(entries)]
+    except ValueError as e:
+        raise ValueError(f"{path}: {e}") from e
+    for key in ["name", "summary"]:
+        values = [getattr(r, key) for r in rules]
+        repeated = sorted({v for v in values if values.count(v) > 1})
+        if len(repeated) > 0:
+            raise ValueError(f"{path}: repeated rule {key}s {repeated}")
+    return rules
+
+
+# Characters that give a pattern a meaning other than its literal text.
+REGEX_CHARACTERS = set(".^$*+?{}[]\\|()")
+
+
+def is_literal(pattern):
+    return not REGEX_CHARACTERS.intersection(pattern)
+
+
+def trie_pattern(literals):
+    # One regex matching any of the literals, with shared prefixes merged into
+    # a trie so that the engine rejects a position on its first character
+    # rather than trying every literal in turn.
+    trie = {}
+    for literal in literals:
+        node = trie
+        for c in literal:
+            node = node.setdefault(c, {})
+        node[""] = {}
+
+    def pattern(node):
+        end = "" in node
+        branches = [re.escape(c) + pattern(child) for c, child in sorted(node.items()) if c]
+        if len(branches) == 0:
+            return ""
+        alternation = "|".join(branches)
+        if end:
+            return f"(?:{alternation})?"
+        return alternation if len(branches) == 1 else f"(?:{alternation})"
+
+    return pattern(trie)
+
+
+class FieldRules:
+    # The rules that check one field. Literal patterns are tested with a
+    # substring search and the rest with one regex per rule. A single screen
+    # (the literals as a trie, plus the regex patterns) finds the records
+    # matching no rule, which are most of them, in one scan.
+    def __init__(self, rules, field):
+        self.rules = []
+        literals = []
+        patterns = []
+        for i, rule in enumerate(rules):
+            rule_literals = [p for p in rule.patterns[field] if is_literal(p)]
+            rule_patterns = [p for p in rule.patterns[field] if not is_literal(p)]
+            if len(rule_literals) + len(rule_patterns) == 0:
+                continue
+            regex = None
+            if len(rule_patterns) > 0:
+                regex = re.compile("|".join(f"(?:{p})" for p in rule_patterns))
+            self.rules.append((i, rule_literals, regex))
+            literals += rule_literals
+            patterns += rule_patterns
+        if len(literals) > 0:
+            patterns.insert(0, trie_pattern(literals))
+        self.screen = re.compile("|".join(f"(?:{p})" for p in patterns))
+
+    def first_rule(self, s, no_match):
+        if self.screen.search(s) is None:
+            return no_match
+        for i, literals, regex in self.rules:
+            if any(l in s for l in literals) or (regex is not None and regex.search(s)):
+                return i
+        return no_match
+
+
+class CompiledRules:
+    def __init__(self, rules):
+        self.rules = rules
+        self.no_match = len(rules)
+        self.fields = {f: FieldRules(rules, f) for f in FIELDS}
+        # Exclusion workbook sheets, in the order they are written, and the
+        # index of the sheet for each rule and field.
+        self.sheet_names = []
+        self.sheet_table = numpy.full((len(rules), len(FIELDS)), -1)
+        for i, rule in enumerate(rules):
+            for field in rule.fields():
+                self.sheet_table[i, FIELDS.index(field)] = len(self.sheet_names)
+                self.sheet_names.append(rule.sheet_name(field))
+
+    def match_field(self, df, field):
+        # Index of the first rule matching each record in this field, or
+        # self.no_match. Each distinct value is checked once, which matters
+        # most for journals and publication types, and the results are mapped
+        # back to the records through their factorized codes. Categorical
+        # columns (see intermediate.py) are factorized already.
+        field_rules = self.fields[field]
+        if len(field_rules.rules) == 0 or field not in df.columns:
+            return numpy.full(len(df), self.no_match)
+        if isinstance(df[field].dtype, pandas.CategoricalDtype):
+            codes, uniques = df[field].cat.codes.to_numpy(), df[field].cat.categories
+        else:
+            codes, uniques = pandas.factorize(df[field])
+        values = pandas.Series(uniques, dtype=object).str.lower().fillna("")
+        # Missing values have code -1, so take the result for "" from the end.
+        results = numpy.fromiter(
+            (field_rules.first_rule(s, self.no_match) for s in list(values) + [""]),
+            dtype=numpy.int64,
+            count=len(values) + 1,
+        )
+        return results[codes]
+
+    def match(self, df, profiler=None):
+        field_codes = {}
+        for f in FIELDS:
+            if profiler is None:
+                field_codes[f] = self.match_field(df, f)
+                continue
+            with profiler.stage(f"rules: {f}", len(df)) as stage:
+                field_codes[f] = self.match_field(df, f)
+                stage["rows_out"] = (field_codes[f] == self.no_match).sum()
+        codes = numpy.minimum.reduce(list(field_codes.values()))
+        return codes, field_codes
+
+
+def rule_counts(compiled, codes, field_codes):
+    # Number of records excluded by each rule, and by each field of each rule.
+    counts = numpy.bincount(codes, minlength=compiled.no_match + 1)[: compiled.no_match]
+    field_counts = {}
+    for i, rule in enumerate(compiled.rules):
+        for field in rule.fields():
+            field_counts[(i, field)] = ((codes == i) & (field_codes[field] == i)).sum()
+    return counts, field_counts
+
+
+def sheet_codes(compiled, codes, field_codes):
+    # Index into compiled.sheet_names of the sheet each excluded record is
+    # reported on, or -1 for records that were not excluded. A record goes on
+    # the sheet of the first of its rule's fields that matched it.
+    field_index = numpy.full(len(codes), -1)
+    for j in reversed(range(len(FIELDS))):
+        field_index[field_codes[FIELDS[j]] == codes] = j
+    excluded = codes != compiled.no_match
+    result = numpy.full(len(codes), -1)
+    result[excluded] = compiled.sheet_table[codes[excluded], field_index[excluded]]
+    return result
+
+
+def profile_rules(profiler, compiled, df, counts, singles=None):
+    # Records the rows in and out of each rule, in order. With singles (each
+    # rule compiled on its own), also times each rule by matching it alone,
+    # as the combined pass cannot be split by rule.
+    remaining = len(df)
+    for i, rule in enumerate(compiled.rules):
+        seconds = None
+        if singles is not None:
+            start = time.perf_counter()
+            singles[i].match(df)
+            seconds = time.perf_counter() - start
+        profiler.add(f"rule: {rule.name}", seconds, remaining, remaining - counts[i])
+        remaining -= counts[i]
+
+
+def print_rule_counts(compiled, counts, field_counts, remaining):
+    for i, rule in enumerate(compiled.rules):
+        if len(rule.fields()) > 1:
+            for field in rule.fields():
+                print(f"{field}: {field_counts[(i, field)]}")
+        print(f"Removed {counts[i]} {rule.name}; was {remaining} is now {remaining - counts[i]}")
+        remaining -= counts[i]
@@ -0,0 +1,159 @@
+# Content-addressed cache of pipeline stage outputs.
+#
+# Each entry is keyed by a hash of the stage's input files, the source of the
+# code that produces it and any configuration it depends on, and holds copies
+# of the files the stage wrote plus its (JSON-serialisable) return value. When
+# the key is unchanged the files are restored instead of re-running the stage.
+# Least recently used entries are evicted when the cache grows beyond
+# STAGE_CACHE_MAX_BYTES.
+#
+# Usage: python basic_processing/stage_cache.py {list,clear,prune}
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+CACHE_DIR = os.environ.get("STAGE_CACHE_DIR", ".stage-cache")
+MAX_BYTES = int(os.environ.get("STAGE_CACHE_MAX_BYTES", 4 * 1024**3))
+
+
+def update_with_file(h, path):
+    h.update(f"{os.path.getsize(path)}:".encode())
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+
+
+def stage_key(stage, files=(), code=(), config=None, parent=None):
+    # files are the stage's inputs, code the source files that implement it.
+    # parent chains the key to a previous stage's key.
+    h = hashlib.sha256()
+    h.update(f"{stage}\0{parent}\0{config!r}\0".encode())
+    for path in list(files) + list(code):
+        update_with_file(h, path)
+    return h.hexdigest()
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            total += os.path.getsize(os.path.join(root, f))
+    return total
+
+
+class StageCache:
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def entry_dir(self, key):
+        return os.path.join(self.directory, key)
+
+    def read_meta(self, key):
+        with open(os.path.join(self.entry_dir(key), "meta.json")) as f:
+            return json.load(f)
+
+    def write_meta(self, key, meta, directory=None):
+        with open(os.path.join(directory or self.entry_dir(key), "meta.json"), "w") as f:
+            json.dump(meta, f, indent=1)
+
+    def has(self, key):
+        return os.path.exists(os.path.join(self.entry_dir(key), "meta.json"))
+
+    def entry_path(self, key, name):
+        return os.path.join(self.entry_dir(key), name)
+
+    def cached_file(self, key, i):
+        # The cached copy of the stage's i-th output, for reading in place.
+        path = self.read_meta(key)["outputs"][i]
+        return self.entry_path(key, f"{i}-{os.path.basename(path)}")
+
+    def touch(self, key):
+        # Marks the entry as recently used and returns its result.
+        meta = self.read_meta(key)
+        meta["used"] = time.time()
+        self.write_meta(key, meta)
+        return meta["result"]
+
+    def restore(self, key):
+        # Copies the cached files back to where the stage wrote them and
+        # returns the stage's result.
+        meta = self.read_meta(key)
+        for i, path in enumerate(meta["outputs"]):
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            shutil.copyfile(self.cached_file(key, i), path)
+        print(f"Restored {meta['stage']} from cache")
+        return self.touch(key)
+
+    def store(self, key, stage, outputs, result=None):
+        tmp = self.entry_dir(key) + f".tmp{os.getpid()}"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for i, path in enumerate(outputs):
+            shutil.copyfile(path, os.path.join(tmp, f"{i}-{os.path.basename(path)}"))
+        now = time.time()
+        meta = {
+            "stage": stage,
+            "outputs": list(outputs),
+            "result": result,
+            "created": now,
+            "used": now,
+            "size": directory_size(tmp),
+        }
+        self.write_meta(key, meta, tmp)
+        shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+        os.replace(tmp, self.entry_dir(key))
+        self.evict()
+
+    def entries(self):
+        if not os.path.isdir(self.directory):
+            return []
+        result = []
+        for key in os.listdir(self.directory):
+            if self.has(key):
+                result.append(dict(self.read_meta(key), key=key))
+        return sorted(result, key=lambda e: e["used"])
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(e["size"] for e in entries)
+        while total > self.max_bytes and len(entries) > 0:
+            e = entries.pop(0)
+            shutil.rmtree(self.entry_dir(e["key"]), ignore_errors=True)
+            total -= e["size"]
+            print(f"Evicted {e['stage']} from cache")
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "command",
+        choices=["list", "clear", "prune"],
+        help="list entries, remove all entries, or evict down to the size limit",
+    )
+    args = parser.parse_args()
+
+    cache = StageCache()
+    if args.command == "list":
+        entries = cache.entries()
+        for e in entries:
+            used = time.strftime("%Y-%m-%d %H:%M", time.localtime(e["used"]))
+            print(f"{e['key'][:12]}  {e['size'] / 1e6:10.1f} MB  {used}  {e['stage']}")
+        total = sum(e["size"] for e in entries)
+        print(f"{len(entries)} entries, {total / 1e6:.1f} MB of {cache.max_bytes / 1e6:.0f} MB")
+    elif args.command == "clear":
+        cache.clear()
+    elif args.command == "prune":
+        cache.evict()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
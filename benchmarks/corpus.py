@@ -0,0 +1,311 @@
+# Generates a synthetic set of database exports, laid out as in
+# database-search-results/, for benchmarking the pipeline without the real
+# exports.
+#
+# Each source draws records from a pool of works shared with the other
+# sources (overlap_rate of its records) and from works of its own, and
+# repeats duplicate_rate of its records. A share of the works has a title,
+# journal or publication type that an exclusion rule picks up, so the rules
+# do realistic work.
+#
+# Usage: python benchmarks/corpus.py OUTPUT_DIR [--records N]
+#            [--duplicate-rate R] [--overlap-rate R] [--seed S]
+
+import argparse
+import os
+import random
+import sys
+from xml.sax.saxutils import escape, quoteattr
+
+import pandas
+
+SOURCES = ["pubmed", "cinahl", "medline", "psycinfo", "embase", "scopus"]
+
+# Number of export files each source is split across, as the parsers expect.
+PUBMED_FILES = 4
+OVID_FILES = {"medline": 8, "embase": 7}
+SCOPUS_FILES = 2
+
+WORDS = """
+caesarean section delivery birth labour labor pregnancy pregnant women maternal
+neonatal infant outcome outcomes risk factors cohort study trial randomised
+hospital rate rates emergency elective vaginal induction obstetric care uterine
+postpartum haemorrhage infection anaesthesia spinal epidural pain analgesia
+fetal distress breech twin preterm term gestational diabetes hypertension
+preeclampsia obesity age parity previous scar rupture placenta previa accreta
+mortality morbidity admission intensive unit length stay breastfeeding
+depression anxiety fear childbirth satisfaction midwife physician decision
+guideline audit quality improvement cost analysis national regional rural urban
+low middle high income country countries population data register registry
+association associated increased decreased significant odds ratio confidence
+interval compared between among after before during following primary secondary
+""".split()
+PLACES = [
+    "Brazil", "China", "Ethiopia", "India", "Iran", "Nigeria", "Sweden", "Turkey",
+    "the United States", "England", "Australia", "Pakistan", "Egypt", "Nepal",
+]
+SURNAMES = [
+    "Smith", "Garcia", "Wang", "Kumar", "Okafor", "Andersson", "Yilmaz", "Silva",
+    "Khan", "Nguyen", "Müller", "Rossi", "Kowalski", "Haddad", "Tanaka", "Dubois",
+    "Ahmed", "Santos", "Li", "Zhang", "Martínez", "Olsen", "Ivanova", "Mensah",
+]
+GIVEN_NAMES = [
+    "Anna", "James", "Wei", "Priya", "Chidi", "Erik", "Ayse", "Joao", "Sara",
+    "Minh", "Lukas", "Giulia", "Piotr", "Rania", "Yuki", "Claire", "Omar",
+]
+JOURNALS = [
+    "BMC Pregnancy and Childbirth", "BJOG", "Birth", "Midwifery",
+    "American Journal of Obstetrics and Gynecology", "Obstetrics and Gynecology",
+    "Journal of Maternal-Fetal and Neonatal Medicine", "PLoS One", "BMJ Open",
+    "Acta Obstetricia et Gynecologica Scandinavica", "Women and Birth",
+    "International Journal of Gynecology and Obstetrics", "Journal of Affective Disorders",
+]
+# Values that one of the exclusion rules matches.
+EXCLUDED_TITLES = [
+    "A case report of {}", "Study protocol: {}", "Letter to the editor: {}",
+    "A systematic review of {}", "Meta-analysis of {}", "Erratum: {}",
+    "Conference abstract: {}", "Three cases of {}", "Cohort profile: {}",
+]
+EXCLUDED_JOURNALS = [
+    "Medical Hypotheses", "Veterinary Record", "Transplantation Proceedings",
+    "Anesthesia and Analgesia", "Journal of Case Reports", "Systematic Reviews",
+]
+EXCLUDED_PUBLICATION_TYPES = [
+    "Editorial", "Letter", "Comment", "Review", "Case Reports", "Erratum",
+    "Conference Abstract", "News", "Practice Guideline",
+]
+LANGUAGES = ["English"] * 18 + ["French", "Spanish", "Chinese"]
+EXCLUDED_RATE = 0.3
+
+
+class Work:
+    # One article, as a source would export it.
+    def __init__(self, rng, number):
+        words = rng.sample(WORDS, rng.randint(5, 12))
+        title = f"{' '.join(words).capitalize()} in {rng.choice(PLACES)}"
+        self.journal = rng.choice(JOURNALS)
+        self.publication_types = ["Journal Article"]
+        if rng.random() < EXCLUDED_RATE:
+            kind = rng.randrange(3)
+            if kind == 0:
+                title = rng.choice(EXCLUDED_TITLES).format(title.lower())
+            elif kind == 1:
+                self.journal = rng.choice(EXCLUDED_JOURNALS)
+            else:
+                self.publication_types.append(rng.choice(EXCLUDED_PUBLICATION_TYPES))
+        self.title = title
+        self.year = rng.randint(2008, 2024)
+        self.authors = [
+            (rng.choice(SURNAMES), rng.choice(GIVEN_NAMES)) for _ in range(rng.randint(1, 8))
+        ]
+        sentences = []
+        for _ in range(rng.randint(3, 12)):
+            sentence = " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 25)))
+            sentences.append(sentence.capitalize() + ".")
+        self.abstract = " ".join(sentences)
+        self.language = rng.choice(LANGUAGES)
+        self.doi = f"10.{rng.randint(1000, 9999)}/synthetic.{number}" if rng.random() < 0.85 else None
+        self.pmid = str(10000000 + number) if rng.random() < 0.7 else None
+
+
+def source_records(rng, source, records, shared, duplicate_rate, overlap_rate, next_number):
+    # The works one source exports, in export order, including duplicates.
+    own = []
+    for _ in range(records):
+        if rng.random() < overlap_rate:
+            own.append(rng.choice(shared))
+        else:
+            own.append(Work(rng, next_number()))
+    if source == "pubmed":
+        # PubMed only returns records with a PMID.
+        own = [w for w in own if w.pmid is not None]
+    result = []
+    for w in own:
+        result.append(w)
+        if rng.random() < duplicate_rate:
+            result.insert(rng.randrange(len(result)), w)
+    return result
+
+
+def wrap(tag, text, width=80):
+    # MEDLINE-format lines, continued with a six space indent.
+    lines = []
+    line = f"{tag:<4}- "
+    for word in text.split():
+        if len(line) + len(word) + 1 > width and line.strip():
+            lines.append(line.rstrip())
+            line = "      "
+        line += word + " "
+    lines.append(line.rstrip())
+    return "\n".join(lines) + "\n"
+
+
+def medline_record(w):
+    text = f"PMID- {w.pmid}\nOWN - NLM\n"
+    text += wrap("TI", w.title)
+    text += f"DP  - {w.year} Mar\n"
+    text += wrap("AB", w.abstract)
+    for surname, given in w.authors:
+        text += f"AU  - {surname} {given[0]}\n"
+    text += "LA  - " + ("eng" if w.language == "English" else w.language[:3].lower()) + "\n"
+    text += f"JT  - {w.journal}\n"
+    for t in w.publication_types:
+        text += f"PT  - {t}\n"
+    text += "PL  - England\n"
+    if w.doi is not None:
+        text += f"AID - {w.doi} [doi]\n"
+    return text + "\n"
+
+
+def ebsco_record(w, i):
+    ui = ""
+    if w.doi is not None:
+        ui += f'<ui type="doi">{escape(w.doi)}</ui>'
+    if w.pmid is not None:
+        ui += f'<ui type="pmid">NLM{w.pmid}</ui>'
+    authors = "".join(f"<au>{escape(s)}, {escape(g)}</au>" for s, g in w.authors)
+    doctypes = "".join(f"<doctype>{escape(t)}</doctype>" for t in w.publication_types)
+    return (
+        f'<rec resultID="{i}"><header shortDbName="syn" uiTerm={quoteattr(str(i))}>'
+        f"<controlInfo><jinfo><jtl>{escape(w.journal)}</jtl></jinfo>"
+        f'<pubinfo><dt year="{w.year}" month="03" day="01">{w.year}0301</dt></pubinfo>'
+        f"<artinfo>{ui}<tig><atl>{escape(w.title)}</atl></tig><aug>{authors}</aug>"
+        f"<ab>{escape(w.abstract)}</ab><pubtype>Journal</pubtype>{doctypes}</artinfo>"
+        f"<language>{escape(w.language)}</language></controlInfo></header></rec>\n"
+    )
+
+
+OVID_COLUMNS = ["UI", "TI", "DO", "AU", "JN", "CP", "AB", "PT", "LG", "YR"]
+SCOPUS_COLUMNS = [
+    "Authors",
+    "Title",
+    "Year",
+    "Source title",
+    "DOI",
+    "Abstract",
+    "PubMed ID",
+    "Document Type",
+]
+
+
+def ovid_row(w):
+    return {
+        "UI": w.pmid,
+        "TI": w.title,
+        "DO": w.doi,
+        "AU": "\n".join(f"{s}, {g}" for s, g in w.authors),
+        "JN": w.journal,
+        "CP": "England",
+        "AB": w.abstract,
+        "PT": "\n".join(w.publication_types),
+        "LG": w.language,
+        "YR": f"{w.year} Mar",
+    }
+
+
+def scopus_row(w):
+    return {
+        "Authors": "; ".join(f"{s} {g[0]}." for s, g in w.authors),
+        "Title": w.title,
+        "Year": w.year,
+        "Source title": w.journal,
+        "DOI": w.doi,
+        "Abstract": w.abstract,
+        "PubMed ID": w.pmid,
+        "Document Type": "; ".join(w.publication_types),
+    }
+
+
+def split(items, n):
+    size = -(-len(items) // n)
+    return [items[i * size : (i + 1) * size] for i in range(n)]
+
+
+def write_source(root, source, works):
+    exports = os.path.join(root, "database-search-results")
+    if source == "pubmed":
+        os.makedirs(f"{exports}/PubMed", exist_ok=True)
+        for i, part in enumerate(split(works, PUBMED_FILES)):
+            with open(f"{exports}/PubMed/pubmed-caesareanT-set({i}).txt", "w") as f:
+                for w in part:
+                    f.write(medline_record(w))
+    elif source in ("cinahl", "psycinfo"):
+        directory = {"cinahl": "CINAHL", "psycinfo": "PsycINFO"}[source]
+        os.makedirs(f"{exports}/{directory}", exist_ok=True)
+        with open(f"{exports}/{directory}/{source}_export.xml", "w", encoding="utf-8") as f:
+            f.write("<records>\n")
+            for i, w in enumerate(works):
+                f.write(ebsco_record(w, i + 1))
+            f.write("</records>\n")
+    elif source in OVID_FILES:
+        # Written as .xlsx content under the .xls names the parser reads;
+        # pandas picks the reader from the file's content.
+        directory = {"medline": "OVID-Medline", "embase": "Embase"}[source]
+        os.makedirs(f"{exports}/{directory}", exist_ok=True)
+        for i, part in enumerate(split(works, OVID_FILES[source])):
+            pandas.DataFrame([ovid_row(w) for w in part], columns=OVID_COLUMNS).to_excel(
+                f"{exports}/{directory}/citation({i}).xls",
+                sheet_name="citations",
+                index=False,
+                engine="openpyxl",
+            )
+    elif source == "scopus":
+        os.makedirs(f"{exports}/Scopus", exist_ok=True)
+        for i, part in enumerate(split(works, SCOPUS_FILES)):
+            pandas.DataFrame([scopus_row(w) for w in part], columns=SCOPUS_COLUMNS).to_csv(
+                f"{exports}/Scopus/scopus({i}).csv", index=False
+            )
+
+
+def generate(root, records=2000, duplicate_rate=0.05, overlap_rate=0.3, seed=0):
+    # records is a number of records for every source, or a dict of source
+    # name to number. Returns the number of records written for each source.
+    rng = random.Random(seed)
+    if not isinstance(records, dict):
+        records = {s: records for s in SOURCES}
+    number = 0
+
+    def next_number():
+        nonlocal number
+        number += 1
+        return number
+
+    shared = [Work(rng, next_number()) for _ in range(max(1, max(records.values()) // 2))]
+    written = {}
+    for source in SOURCES:
+        works = source_records(
+            rng, source, records[source], shared, duplicate_rate, overlap_rate, next_number
+        )
+        write_source(root, source, works)
+        written[source] = len(works)
+    os.makedirs(os.path.join(root, "outputs/database-search-results"), exist_ok=True)
+    os.makedirs(os.path.join(root, "outputs/basic-processing/basic-exclusions"), exist_ok=True)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output", help="directory to create the exports in")
+    parser.add_argument("--records", type=int, default=2000, help="records per source")
+    parser.add_argument(
+        "--duplicate-rate",
+        type=float,
+        default=0.05,
+        help="share of records repeated within a source",
+    )
+    parser.add_argument(
+        "--overlap-rate",
+        type=float,
+        default=0.3,
+        help="share of records drawn from works shared between sources",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    written = generate(args.output, args.records, args.duplicate_rate, args.overlap_rate, args.seed)
+    for source, n in written.items():
+        print(f"Wrote {n} {source} records")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,235 @@
+# Times each pipeline stage on a synthetic corpus (see benchmarks/corpus.py)
+# and records the results as JSON, so that runs on different versions can be
+# compared.
+#
+# Stages timed: each source's parser, process() for each source, every
+# exclusion rule on its own over each source's normalised records, each
+# merge_set step and near-duplicate detection on the merged records.
+#
+# Usage: python benchmarks/run_benchmarks.py [--records N]
+#            [--duplicate-rate R] [--overlap-rate R] [--seed S]
+#            [--format {parquet,csv}] [--repeat N] [--output PATH]
+#            [--compare PATH] [--keep DIR]
+
+import argparse
+import contextlib
+import copy
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "basic_processing"))
+sys.path.insert(0, os.path.join(ROOT, "database-search-results"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import basic_processing
+import corpus
+import intermediate
+import merge_datasets
+import near_duplicates
+import normalise
+import rule_engine
+import sources
+
+
+def rule_frame(source):
+    # A source's records as the exclusion rules see them.
+    df = intermediate.read_frame(basic_processing.source_path(source))
+    df, _, _ = basic_processing.prefilter(df)
+    normalise.normalise(df, "," if source == "pubmed" else ";")
+    return df.set_index("dedup_index")
+
+
+class Timer:
+    # Runs stages, keeping the fastest of repeat runs of each, with the
+    # output they print captured.
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = []
+
+    def run(self, stage, name, f, rows_in=None, rows_out=None):
+        times = []
+        for _ in range(self.repeat):
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                result = f()
+                times.append(time.perf_counter() - start)
+        record = {"stage": stage, "name": name, "seconds": min(times), "runs": times}
+        if rows_in is not None:
+            record["rows_in"] = int(rows_in)
+        if rows_out is not None:
+            record["rows_out"] = int(rows_out() if callable(rows_out) else rows_out)
+        self.results.append(record)
+        print(f"{stage:>15} {name:<40} {min(times):9.3f}s")
+        return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args, work_dir):
+    written = corpus.generate(
+        work_dir, args.records, args.duplicate_rate, args.overlap_rate, args.seed
+    )
+    os.chdir(work_dir)
+    timer = Timer(args.repeat)
+
+    def rows(stem):
+        return lambda: len(intermediate.read_frame(stem))
+
+    for source in corpus.SOURCES:
+        timer.run(
+            "parse",
+            source,
+            lambda: sources.parse([source]),
+            written[source],
+            rows(basic_processing.source_path(source)),
+        )
+
+    for source in corpus.SOURCES:
+        path = basic_processing.source_path(source)
+        result = timer.run(
+            "process",
+            source,
+            lambda: basic_processing.process(source, path),
+            rows(path)(),
+            rows(basic_processing.processed_path(source)),
+        )
+        # The summary counts, so that changes in behaviour show up too.
+        timer.results[-1]["counts"] = dict(
+            zip(basic_processing.SUMMARY_INDEX, (int(n) for n in result))
+        )
+        df = rule_frame(source)
+        for rule in basic_processing.EXCLUSION_RULES:
+            compiled = rule_engine.CompiledRules([rule])
+            timer.run(
+                "rule",
+                f"{source}: {rule.name}",
+                lambda: compiled.match(df),
+                len(df),
+                lambda: (compiled.match(df)[0] == compiled.no_match).sum(),
+            )
+
+    index = merge_datasets.DedupIndex()
+    for source in merge_datasets.MERGE_ORDER:
+        path = basic_processing.processed_path(source)
+        before = len(index)
+        # merge_set adds to the index, so each repeat starts from a copy.
+        snapshot = (list(index.frames), copy.deepcopy(index.keys), index.length)
+
+        def merge():
+            index.frames, index.keys, index.length = (
+                list(snapshot[0]),
+                copy.deepcopy(snapshot[1]),
+                snapshot[2],
+            )
+            merge_datasets.merge_set(source, path, index)
+
+        timer.run("merge", source, merge, rows(path)(), lambda: len(index) - before)
+
+    merged = index.merged().set_index("dedup_index")
+    timer.run(
+        "near-duplicates",
+        "merged",
+        lambda: near_duplicates.find_clusters(merged),
+        len(merged),
+        lambda: near_duplicates.find_clusters(merged)["cluster"].nunique(),
+    )
+
+    return {
+        "commit": git_commit(),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pandas.__version__,
+        "platform": platform.platform(),
+        "config": {
+            "records": args.records,
+            "duplicate_rate": args.duplicate_rate,
+            "overlap_rate": args.overlap_rate,
+            "seed": args.seed,
+            "format": intermediate.intermediate_format(),
+            "repeat": args.repeat,
+        },
+        "exported": written,
+        "results": timer.results,
+    }
+
+
+def compare(results, path):
+    # Prints the change in time of each stage from an earlier results file.
+    with open(path) as f:
+        previous = json.load(f)
+    before = {(r["stage"], r["name"]): r["seconds"] for r in previous["results"]}
+    print(f"\nCompared with {previous.get('commit')} ({previous.get('created')}):")
+    if previous.get("config") != results["config"]:
+        print(f"Note: different configuration {previous.get('config')}")
+    for r in results["results"]:
+        key = (r["stage"], r["name"])
+        if key not in before or r["stage"] == "rule":
+            continue
+        change = r["seconds"] / before[key] - 1 if before[key] > 0 else 0
+        print(f"{r['stage']:>15} {r['name']:<40} {before[key]:9.3f}s -> {r['seconds']:9.3f}s {change:+7.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=2000, help="records per source")
+    parser.add_argument("--duplicate-rate", type=float, default=0.05)
+    parser.add_argument("--overlap-rate", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--format", choices=intermediate.FORMATS)
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="runs of each stage; the fastest is kept"
+    )
+    parser.add_argument(
+        "--output",
+        help="results file (default: benchmarks/results/<commit>-<records>.json)",
+    )
+    parser.add_argument("--compare", help="earlier results file to compare with")
+    parser.add_argument("--keep", help="generate the corpus in this directory and keep it")
+    args = parser.parse_args()
+
+    if args.format is not None:
+        os.environ["INTERMEDIATE_FORMAT"] = args.format
+    output = args.output or os.path.join(
+        ROOT, "benchmarks", "results", f"{git_commit() or 'unknown'}-{args.records}.json"
+    )
+    output = os.path.abspath(output)
+    cwd = os.getcwd()
+    if args.keep is not None:
+        os.makedirs(args.keep, exist_ok=True)
+        results = run(args, os.path.abspath(args.keep))
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            results = run(args, tmp)
+            os.chdir(cwd)
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=1)
+    print(f"Wrote {output}")
+    if args.compare is not None:
+        compare(results, os.path.join(cwd, args.compare))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,89 +1,121 @@
 import re
 import sys
 
+from lxml import etree
 import pandas
+from pandas.io.parsers import TextParser
 
-XSL = """<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
-<xsl:output method="xml" omit-xml-declaration="no" indent="yes"/>
-<xsl:strip-space elements="*"/>
-<xsl:template match="/records">
-    <xsl:copy>
-        <xsl:apply-templates select="rec"/>
-    </xsl:copy>
-</xsl:template>
-<xsl:template match="rec">
-    <xsl:copy>
-        <xsl:copy-of select="header/controlInfo/artinfo/tig/atl"/>
-        <year><xsl:value-of select="header/controlInfo/pubinfo/dt/@year"/></year>
-        <authors>
-            <xsl:for-each select="header/controlInfo/artinfo/aug/au">
-                <xsl:value-of select="." />;
-            </xsl:for-each>
-        </authors>
-        <xsl:copy-of select="header/controlInfo/artinfo/ab"/>
-
-        <xsl:for-each select="header/controlInfo/artinfo/ui">
-             <xsl:variable name="ui_type" select="./@type"/>
-             <xsl:element name="{$ui_type}">
-                 <xsl:value-of select="." />
-             </xsl:element>
-        </xsl:for-each>
-
-        <xsl:copy-of select="header/controlInfo/jinfo/jtl" />
-        <xsl:copy-of select="header/controlInfo/artinfo/pubtype"/>
-        <doctypes>
-             <xsl:for-each select="header/controlInfo/artinfo/doctype">
-                  <xsl:value-of select="." />;
-             </xsl:for-each>
-        </doctypes>
-        <xsl:copy-of select="header/controlInfo/language"/>
-    </xsl:copy>
-</xsl:template>
-</xsl:stylesheet>"""
-
-
-def get_data(path):
-    data = pandas.read_xml(path, stylesheet=XSL)
-    data["authors"] = data["authors"].apply(tidy_list_str)
-    data["doctypes"] = data["doctypes"].apply(tidy_list_str)
-    data = data.rename(
-        columns={
-            "atl": "title",
-            "dt": "year",
-            "ab": "abstract",
-            "jtl": "journal",
-            "doctypes": "publication types",
-        }
-    )
-    data["pmid"] = data["pmid"].apply(tidy_pmid)
+import sources
+
+# Fields read from each header/controlInfo element of an EBSCO export rec,
+# named as in the output. ui elements add a column named after their type.
+COLUMNS = [
+    "title",
+    "year",
+    "authors",
+    "abstract",
+    "doi",
+    "pmid",
+    "journal",
+    "pubtype",
+    "publication types",
+    "language",
+]
+CHUNK_SIZE = 10000
+
+
+def leading_text(el):
+    # Text of an element up to its first child. Whitespace-only text is
+    # treated as missing.
+    if el is None or not el.text or el.text.isspace():
+        return None
+    return el.text
+
+
+def string_value(el):
+    # All text inside an element, ignoring whitespace-only text nodes.
+    return "".join(t for t in el.itertext() if not t.isspace())
+
+
+def joined_values(elements):
+    if len(elements) == 0:
+        return None
+    return "".join(string_value(el) + ";" for el in elements)
+
+
+def last(elements):
+    return elements[-1] if len(elements) > 0 else None
+
+
+def rec_row(rec):
+    info = rec.find("header/controlInfo")
+    if info is None:
+        return {c: None for c in COLUMNS}
+    dt = info.find("pubinfo/dt")
+    row = {
+        "title": leading_text(last(info.findall("artinfo/tig/atl"))),
+        "year": dt.get("year") or None if dt is not None else None,
+        "authors": joined_values(info.findall("artinfo/aug/au")),
+        "abstract": leading_text(last(info.findall("artinfo/ab"))),
+        "doi": None,
+        "pmid": None,
+        "journal": leading_text(last(info.findall("jinfo/jtl"))),
+        "pubtype": leading_text(last(info.findall("artinfo/pubtype"))),
+        "publication types": joined_values(info.findall("artinfo/doctype")),
+        "language": leading_text(last(info.findall("language"))),
+    }
+    for ui in info.findall("artinfo/ui"):
+        if ui.get("type") in row:
+            row[ui.get("type")] = string_value(ui) or None
+    return row
+
+
+def chunk_frame(rows, start):
+    # Converts rows with the same type inference read_xml used.
+    with TextParser([list(r.values()) for r in rows], names=COLUMNS) as tp:
+        data = tp.read()
+    data.index = range(start, start + len(data))
+    data["authors"] = data["authors"].apply(sources.tidy_list_str)
+    data["publication types"] = data["publication types"].apply(sources.tidy_list_str)
+    data["pmid"] = data["pmid"].apply(sources.tidy_pmid)
+    # Keep numeric columns as floats so that every chunk writes them the same
+    # way, as they were when the whole file was read at once (read_xml gave
+    # float years, as some records have none).
+    data["year"] = pandas.to_numeric(data["year"], errors="coerce").astype(float)
+    if pandas.api.types.is_numeric_dtype(data["pmid"]):
+        data["pmid"] = data["pmid"].astype(float)
     return data
 
 
-def tidy_list_str(s):
-    if pandas.isna(s):
-        return s
-    authors = s.split(";")
-    result = []
-    for a in authors:
-        result.append(a.strip())
-    return ";".join(result)
+def iter_chunks(path):
+    # Walks the rec elements one at a time, yielding DataFrames of up to
+    # CHUNK_SIZE records.
+    rows = []
+    start = 0
+    for _, rec in etree.iterparse(path, events=("end",), tag="rec"):
+        rows.append(rec_row(rec))
+        # Free the record, and the references the root keeps to earlier ones.
+        rec.clear()
+        while rec.getprevious() is not None:
+            del rec.getparent()[0]
+        if len(rows) == CHUNK_SIZE:
+            yield chunk_frame(rows, start)
+            start += len(rows)
+            rows = []
+    if len(rows) > 0 or start == 0:
+        yield chunk_frame(rows, start)
 
 
-def tidy_pmid(s):
-    # Remove "NLM" prefix
-    if (
-        pandas.isna(s)
-        or isinstance(s, int)
-        or isinstance(s, float)
-        or not s.startswith("NLM")
-    ):
-        return s
-    return s[3:]
+CINAHL = sources.register(
+    sources.Adapter("cinahl", "database-search-results/CINAHL/*.xml", iter_chunks, __file__)
+)
+PSYCINFO = sources.register(
+    sources.Adapter("psycinfo", "database-search-results/PsycINFO/*.xml", iter_chunks, __file__)
+)
 
 
 def main():
-    get_data("database-search-results/CINAHL/cinahl_export.xml").to_csv("outputs/database-search-results/cinahl.csv")
-    get_data("database-search-results/PsycINFO/psycinfo_export.xml").to_csv("outputs/database-search-results/psycinfo.csv")
+    sources.parse(["cinahl", "psycinfo"])
 
 
 if __name__ == "__main__":
@@ -1,53 +1,84 @@
-import re
+import os
 import sys
 
 import pandas
 
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "basic_processing")
+)
+import intermediate
+import sources
+import stage_cache
+
+
+# Columns read from the "citations" sheet of each workbook, and their names.
+COLUMNS = {
+    "UI": "pmid",
+    "TI": "title",
+    "DO": "doi",
+    "AU": "authors",
+    "JN": "journal",
+    "CP": "country",
+    "AB": "abstract",
+    "PT": "publication types",
+    "LG": "language",
+    "YR": "year",
+}
+CONVERTED_DIR = "outputs/database-search-results/ovid-workbooks"
+
+
+def converted_path(path):
+    # e.g. Embase/citation(3).xls is converted to ovid-workbooks/Embase-citation(3)
+    directory = os.path.basename(os.path.dirname(path))
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return f"{CONVERTED_DIR}/{directory}-{stem}"
+
 
 def read_single(path):
-    print(f"Reading {path}")
-    data = pandas.read_excel(path, "citations")
-    data = data[
-        ["UI", "TI", "DO", "AU", "JN", "CP", "AB", "PT", "LG", "YR"]
-    ]
-    data = data.rename(
-        columns={
-            "UI": "pmid",
-            "TI": "title",
-            "DO": "doi",
-            "AU": "authors",
-            "JN": "journal",
-            "CP": "country",
-            "AB": "abstract",
-            "PT": "publication types",
-            "LG": "language",
-            "YR": "year",
-        }
+    # Each workbook is parsed once and saved in the intermediate format, which
+    # is read instead for as long as the workbook and this code are unchanged.
+    converted = converted_path(path)
+    key = stage_cache.stage_key(
+        "ovid workbook",
+        files=[path],
+        code=[__file__, sources.__file__, intermediate.__file__],
+        config=intermediate.intermediate_format(),
     )
-    data["year"] = data["year"].apply(tidy_year)
-    return data
+    key_path = f"{converted}.key"
+    if os.path.exists(key_path):
+        with open(key_path) as f:
+            if f.read() == key:
+                print(f"Reading {path} (converted)")
+                return intermediate.read_frame(converted)
 
+    print(f"Reading {path}")
+    data = pandas.read_excel(path, "citations", usecols=list(COLUMNS))
+    data = data[list(COLUMNS)].rename(columns=COLUMNS)
+    data["year"] = sources.tidy_years(data["year"])
+    os.makedirs(CONVERTED_DIR, exist_ok=True)
+    intermediate.write_frame(data, converted)
+    with open(key_path, "w") as f:
+        f.write(key)
+    # Read back, so that the result is the same as when it is reused.
+    return intermediate.read_frame(converted)
 
-def tidy_year(s):
-    if pandas.isna(s) or not isinstance(s, str):
-        return s
-    year = re.findall(r"(19\d{2}|20\d{2})", s)
-    if len(year) == 0:
-        return s
-    return year[0]
 
+def read(path):
+    yield read_single(path)
 
-def get_data(path, num_files):
-    data = []
-    for i in range(num_files):
-        data.append(read_single(f"{path}/citation({i}).xls"))
 
-    return pandas.concat(data)
+MEDLINE = sources.register(
+    sources.Adapter(
+        "medline", "database-search-results/OVID-Medline/citation(*).xls", read, __file__
+    )
+)
+EMBASE = sources.register(
+    sources.Adapter("embase", "database-search-results/Embase/citation(*).xls", read, __file__)
+)
 
 
 def main():
-    get_data("database-search-results/OVID-Medline", 8).to_csv("outputs/database-search-results//medline.csv")
-    get_data("database-search-results/Embase", 7).to_csv("outputs/database-search-results//embase.csv")
+    sources.parse(["medline", "embase"])
 
 
 if __name__ == "__main__":
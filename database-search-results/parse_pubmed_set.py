@@ -1,8 +1,13 @@
 # Reads a file generated by PubMed and exports the relevant data to a csv file.
 
+import csv
 import re
 import sys
 
+import pandas
+
+import sources
+
 
 PMID = "PMID"
 TITLE = "TI"  # Note may need to remove "[]" surrounding title text if not English
@@ -21,6 +26,24 @@ ARTICLE_ID = "AID"
 
 
 class PubmedEntry:
+    # Values repeated across records (language, journal, publication types and
+    # country) are interned. The raw text of the record is only kept when
+    # asked for, as its byte offsets in the export (see raw_text).
+    __slots__ = (
+        "pmid",
+        "title",
+        "author_list",
+        "year",
+        "abstract",
+        "language",
+        "journal",
+        "publication_types",
+        "mesh_terms",
+        "country",
+        "doi",
+        "raw_offsets",
+    )
+
     def __init__(self):
         self.pmid = ""
         self.title = ""
@@ -33,7 +56,7 @@ class PubmedEntry:
         self.mesh_terms = []
         self.country = []
         self.doi = ""
-        self.pubmed_str = ""
+        self.raw_offsets = None
 
     def __repr__(self):
         return f"PubmedEntry: {self.pmid}, {self.title}, {self.year}"
@@ -47,40 +70,67 @@ class PubmedEntry:
     def __hash__(self):
         return int(self.pmid)
 
-    def to_list(self):
-        def esc_list(l):
-            return ['"' + i + '"' for i in l]
-
-        return esc_list(
-            [
-                self.pmid,
-                self.title,
-                self.year,
-                ",".join(self.author_list),
-                self.abstract,
-                self.language,
-                self.journal,
-                ",".join(self.mesh_terms),
-                ",".join(self.publication_types),
-                ",".join(self.country),
-                self.doi,
-            ]
-        )
-
-
-def parse_file(f):
-    lines = f.readlines()
-    pes = []
+    def to_row(self):
+        return [
+            self.pmid,
+            self.title,
+            self.year,
+            ",".join(self.author_list),
+            self.abstract,
+            self.language,
+            self.journal,
+            ",".join(self.mesh_terms),
+            ",".join(self.publication_types),
+            ",".join(self.country),
+            self.doi,
+        ]
+
+
+class PmidSet:
+    # Compact set of integer PMIDs, stored as a bitmap.
+    def __init__(self):
+        self.bits = bytearray()
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, pmid):
+        i = int(pmid)
+        return i // 8 < len(self.bits) and bool(self.bits[i // 8] & (1 << (i % 8)))
+
+    def add(self, pmid):
+        i = int(pmid)
+        if i // 8 >= len(self.bits):
+            self.bits.extend(bytes(max(i // 8 + 1 - len(self.bits), len(self.bits))))
+        if not self.bits[i // 8] & (1 << (i % 8)):
+            self.bits[i // 8] |= 1 << (i % 8)
+            self.count += 1
+
+
+def close_entry(pe, start, end, keep_raw):
+    if keep_raw:
+        pe.raw_offsets = (start, end)
+    return pe
+
+
+def parse_file(f, keep_raw=False):
+    # Yields one PubmedEntry at a time, reading the file (opened in binary
+    # mode) line by line. With keep_raw, each entry records where its text is
+    # in the file.
     pe = None
     tag = None
+    offset = 0
+    start = 0
 
-    for line in lines:
+    for raw in f:
+        line = raw.decode("utf-8")
         splits = line.split("-", 1)
         if len(splits) == 2 and splits[0][0] != " ":
             tag = splits[0].strip()
-            content = splits[1].strip().replace('"', "'")
+            content = splits[1].strip()
         else:
-            content = line.strip().replace('"', "'")
+            content = line.strip()
 
         # print(f"tag:{tag}")
         # print(f"content:{content}\n")
@@ -88,81 +138,127 @@ def parse_file(f):
         if tag == PMID:
             # Close the last PubmedEntry.
             if pe is not None:
-                pes.append(pe)
+                yield close_entry(pe, start, offset, keep_raw)
             # Start a new PubmedEntry.
             pe = PubmedEntry()
             pe.pmid = content
+            start = offset
         elif tag == TITLE:
             pe.title += " " + content
             pe.title = pe.title.strip()
         elif tag == AUTHOR:
             pe.author_list.append(content)
         elif tag == YEAR:
-            year = re.findall(r"(19\d{2}|20\d{2})", content)
-            if len(year) == 1:
-                pe.year = year[0]
+            year = sources.first_year(content)
+            if year != "":
+                pe.year = year
         elif tag == ABSTRACT or tag == ORIGINAL_ABSTRACT:
             pe.abstract += " " + content
             pe.abstract = pe.abstract.strip()
         elif tag == JOURNAL:
-            pe.journal = content
+            pe.journal = sys.intern(content)
         elif tag == LANGUAGE:
-            pe.language = content
+            pe.language = sys.intern(content)
         elif tag == MESH:
             pe.mesh_terms.append(content)
         elif tag == PUBLICATION_TYPE:
-            pe.publication_types.append(content)
+            pe.publication_types.append(sys.intern(content))
         elif tag == COUNTRY:
-            pe.country.append(content)
+            pe.country.append(sys.intern(content))
         elif tag == ARTICLE_ID:
             if "[doi]" in content:
                 pe.doi = re.sub(r" \[doi\]", "", content)
 
         assert pe is not None
-        pe.pubmed_str += line + "\n"
+        offset += len(raw)
 
     # Close the last PubmedEntry.
-    pes.append(pe)
-    return pes
-
-
-def write_csv(pes):
-    with open("outputs/database-search-results/pubmed.csv", "w", encoding="utf-8") as f:
-        f.write(
-            ",".join(
-                [
-                    "pmid",
-                    "title",
-                    "year",
-                    "authors",
-                    "abstract",
-                    "language",
-                    "journal",
-                    "mesh terms",
-                    "publication types",
-                    "country",
-                    "doi",
-                ]
-            )
-        )
-        f.write("\n")
-        f.writelines([",".join(p.to_list()) + "\n" for p in pes])
-
-
-def parse_pubmed_files():
-    entries = []
-    for i in range(4):
-        with open(f"database-search-results/PubMed/pubmed-caesareanT-set({i}).txt", "r") as f:
-            entries += parse_file(f)
-    return entries
+    if pe is not None:
+        yield close_entry(pe, start, offset, keep_raw)
 
 
-def main():
-    all_entries = parse_pubmed_files()
-    pes = set(all_entries)
+def raw_text(path, pe):
+    # The text of an entry parsed with keep_raw from the file at path.
+    start, end = pe.raw_offsets
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(end - start).decode("utf-8")
 
-    print(f"Parsed {len(all_entries)} Pubmed Entries; {len(pes)} unique")
-    write_csv(pes)
+
+BATCH_SIZE = 10000
+HEADER = [
+    "pmid",
+    "title",
+    "year",
+    "authors",
+    "abstract",
+    "language",
+    "journal",
+    "mesh terms",
+    "publication types",
+    "country",
+    "doi",
+]
+
+
+def batches(items):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def batched_frames(rows):
+    empty = True
+    for batch in batches(rows):
+        yield pandas.DataFrame(batch, columns=HEADER)
+        empty = False
+    # Always yield at least one frame, so an empty export still has a header.
+    if empty:
+        yield pandas.DataFrame([], columns=HEADER)
+
+
+def read(path):
+    # The entries of one export, a batch at a time.
+    with open(path, "rb") as f:
+        yield from batched_frames(pe.to_row() for pe in parse_file(f))
+
+
+def unique_frames(frames):
+    # Drops entries whose pmid has already been seen, in these frames or an
+    # earlier one: the exports overlap.
+    seen = PmidSet()
+    parsed = 0
+    for df in frames:
+        parsed += len(df)
+        keep = []
+        for pmid in df["pmid"]:
+            keep.append(pmid not in seen)
+            seen.add(pmid)
+        yield df[keep]
+    print(f"Parsed {parsed} Pubmed Entries; {len(seen)} unique")
+
+
+ADAPTER = sources.register(
+    sources.Adapter(
+        "pubmed",
+        "database-search-results/PubMed/pubmed-caesareanT-set(*).txt",
+        read,
+        __file__,
+        unique_frames,
+        # Every value is quoted, as PubMed's CSV output always has been.
+        index=False,
+        quoting=csv.QUOTE_ALL,
+    )
+)
+
+
+def main():
+    sources.parse(["pubmed"])
 
 
 if __name__ == "__main__":
@@ -2,6 +2,8 @@ import sys
 
 import pandas
 
+import sources
+
 
 def read_single(path):
     scopus_data = pandas.read_csv(path)
@@ -32,11 +34,17 @@ def read_single(path):
     return scopus_data
 
 
+def read(path):
+    yield read_single(path)
+
+
+ADAPTER = sources.register(
+    sources.Adapter("scopus", "database-search-results/Scopus/scopus(*).csv", read, __file__)
+)
+
+
 def main():
-    data = []
-    for i in range(2):
-        data.append(read_single(f"database-search-results/Scopus/scopus({i}).csv"))
-    pandas.concat(data).to_csv("outputs/database-search-results/scopus.csv")
+    sources.parse(["scopus"])
 
 
 if __name__ == "__main__":
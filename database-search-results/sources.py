@@ -0,0 +1,189 @@
+# Registry of source adapters, which read each database's exports the same
+# way.
+#
+# An Adapter finds a source's export files with a glob pattern (relative to
+# the repository root) and reads each with its parser's read function, which
+# yields the file's records as DataFrames of up to a batch of records, with
+# the output's column names and the tidying below applied. A source whose
+# exports overlap (PubMed's) also filters the frames of all its files in turn.
+# Each parser module registers its adapters when imported; load() imports
+# them all. To add a database, write a parser module with a read function,
+# register an Adapter for it there and add the module to MODULES (and the
+# source to basic_processing.SOURCES and merge_datasets.MERGE_ORDER).
+#
+# parse() writes each source's records to outputs/database-search-results,
+# parsing its exports in parallel.
+
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import importlib
+import os
+import re
+import sys
+import tempfile
+
+import pandas
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "basic_processing")
+)
+import intermediate
+
+OUTPUT_DIR = "outputs/database-search-results"
+# Modules that register adapters.
+MODULES = [
+    "parse_pubmed_set",
+    "parse_cinahl_psycinfo_set",
+    "parse_ovid_medline_embase_set",
+    "parse_scopus_set",
+]
+YEAR = re.compile(r"(19\d{2}|20\d{2})")
+
+ADAPTERS = {}
+
+
+class Adapter:
+    # code is the parser module's source file, for cache keys. unique, if
+    # given, filters the frames of all of the source's exports in turn, e.g.
+    # to drop records repeated from an earlier export. index and quoting set
+    # the layout of the CSV output (see intermediate.write_batches), which
+    # keeps each frame's index as read.
+    def __init__(self, name, pattern, read, code, unique=None, index=True, quoting=None):
+        self.name = name
+        self.pattern = pattern
+        self.read = read
+        self.code = [code, __file__, intermediate.__file__]
+        self.unique = unique
+        self.index = index
+        self.quoting = quoting
+
+    def __repr__(self):
+        return f"Adapter: {self.name}, {self.pattern}"
+
+    def output(self):
+        return f"{OUTPUT_DIR}/{self.name}"
+
+    def inputs(self):
+        # Ordered by the numbers in their names, so citation(10).xls follows
+        # citation(9).xls.
+        paths = sorted(glob.glob(self.pattern), key=numbered)
+        if len(paths) == 0:
+            raise FileNotFoundError(f"No {self.name} exports match {self.pattern}")
+        return paths
+
+    def combined(self, frames):
+        return frames if self.unique is None else self.unique(frames)
+
+    def frames(self, paths=None):
+        # Yields the records of the exports at paths (by default all of them)
+        # a batch at a time.
+        if paths is None:
+            paths = self.inputs()
+        return self.combined(frame for path in paths for frame in self.read(path))
+
+    def write_batches(self, frames, stem=None):
+        intermediate.write_batches(
+            frames, stem or self.output(), index=self.index, quoting=self.quoting
+        )
+
+    def write(self, stem=None):
+        self.write_batches(self.frames(), stem)
+
+
+def register(adapter):
+    ADAPTERS[adapter.name] = adapter
+    return adapter
+
+
+def load():
+    for module in MODULES:
+        importlib.import_module(module)
+    return ADAPTERS
+
+
+def get(name):
+    load()
+    if name not in ADAPTERS:
+        raise ValueError(f"Unknown source {name}; expected one of {list(ADAPTERS)}")
+    return ADAPTERS[name]
+
+
+def numbered(path):
+    return [int(s) if s.isdigit() else s for s in re.split(r"(\d+)", path)]
+
+
+def first_year(s):
+    # The year in s if it contains exactly one, else "".
+    years = YEAR.findall(s)
+    return years[0] if len(years) == 1 else ""
+
+
+def tidy_years(years):
+    # The first year in each string, or the string itself if there is none.
+    # Other values are left as they are.
+    if years.dtype != object:
+        return years
+    found = years.str.extract(YEAR, expand=False)
+    return found.where(found.notna(), years)
+
+
+def tidy_list_str(s):
+    # Strips each item of a ";"-separated list.
+    if pandas.isna(s):
+        return s
+    return ";".join(a.strip() for a in s.split(";"))
+
+
+def tidy_pmid(s):
+    # Remove "NLM" prefix
+    if (
+        pandas.isna(s)
+        or isinstance(s, int)
+        or isinstance(s, float)
+        or not s.startswith("NLM")
+    ):
+        return s
+    return s[3:]
+
+
+def write_source(name):
+    get(name).write()
+
+
+def write_part(name, path, stem):
+    # Writes the records of one export, to be combined with the others.
+    adapter = get(name)
+    adapter.write_batches(adapter.read(path), stem)
+    return stem
+
+
+def combine(name, parts):
+    adapter = get(name)
+    frames = (intermediate.read_frame(part, index=adapter.index) for part in parts)
+    adapter.write_batches(adapter.combined(frames))
+
+
+def submit(pool, name, directory):
+    # Parses each of a source's exports by its own task, into a part in
+    # directory; a single export is written straight to the output. Returns
+    # the futures to pass to collect().
+    inputs = get(name).inputs()
+    if len(inputs) == 1:
+        return [pool.submit(write_source, name)]
+    return [
+        pool.submit(write_part, name, path, f"{directory}/{name}-{i}")
+        for i, path in enumerate(inputs)
+    ]
+
+
+def collect(name, futures):
+    parts = [f.result() for f in futures]
+    if len(futures) > 1:
+        combine(name, parts)
+
+
+def parse(names, jobs=None):
+    with ProcessPoolExecutor(max_workers=jobs) as pool, tempfile.TemporaryDirectory() as tmp:
+        futures = {name: submit(pool, name, tmp) for name in names}
+        for name, source_futures in futures.items():
+            collect(name, source_futures)
@@ -0,0 +1,177 @@
+# Runs a full refresh: parses every database export, runs basic processing for
+# each source and merges the results. Parsing and processing are spread across
+# a process pool, and stages whose inputs, code and rules are unchanged are
+# restored from the stage cache (see basic_processing/stage_cache.py).
+#
+# Usage: python pipeline.py [--jobs N] [--skip-parsing] [--skip-merge]
+#                           [--format {parquet,csv}] [--chunk-size N]
+#                           [--no-cache] [--record-store PATH]
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, "basic_processing"))
+sys.path.insert(0, os.path.join(ROOT, "database-search-results"))
+
+import basic_processing
+import dedup_keys
+import exclusion_audit
+import intermediate
+import merge_datasets
+import normalise
+import overlap
+import profiling
+import record_store
+import rule_engine
+import sources
+import stage_cache
+
+PROCESS_CODE = [
+    basic_processing.__file__,
+    dedup_keys.__file__,
+    rule_engine.__file__,
+    normalise.__file__,
+    intermediate.__file__,
+    exclusion_audit.__file__,
+    profiling.__file__,
+    overlap.__file__,
+    record_store.__file__,
+]
+
+
+def parse_key(name):
+    adapter = sources.get(name)
+    return stage_cache.stage_key(
+        f"parse {name}",
+        files=adapter.inputs(),
+        code=adapter.code,
+        config=intermediate.intermediate_format(),
+    )
+
+
+def parse_all(pool, cache):
+    with tempfile.TemporaryDirectory() as tmp:
+        keys = {}
+        futures = {}
+        for name in basic_processing.SOURCES:
+            if cache is not None:
+                keys[name] = parse_key(name)
+                if cache.has(keys[name]):
+                    cache.restore(keys[name])
+                    continue
+            # Each export file is parsed by its own task.
+            futures[name] = sources.submit(pool, name, tmp)
+
+        # Results are collected in submission order, so outputs do not depend
+        # on which worker finishes first.
+        for name, source_futures in futures.items():
+            sources.collect(name, source_futures)
+            if cache is not None:
+                output = intermediate.path(basic_processing.source_path(name))
+                cache.store(keys[name], f"parse {name}", [output])
+
+
+def process_key(name):
+    return stage_cache.stage_key(
+        f"process {name}",
+        files=[intermediate.read_path(basic_processing.source_path(name))],
+        code=PROCESS_CODE,
+        config=(intermediate.intermediate_format(), basic_processing.rule_config()),
+    )
+
+
+def process_all(pool, cache):
+    keys = {}
+    results = {}
+    futures = {}
+    for name in basic_processing.SOURCES:
+        if cache is not None:
+            keys[name] = process_key(name)
+            if cache.has(keys[name]):
+                results[name] = cache.restore(keys[name])
+                continue
+        futures[name] = pool.submit(
+            basic_processing.process, name, basic_processing.source_path(name)
+        )
+
+    for name, future in futures.items():
+        results[name] = [int(n) for n in future.result()]
+        if cache is not None:
+            outputs = [
+                intermediate.path(basic_processing.processed_path(name)),
+                basic_processing.exclusions_path(name),
+                intermediate.path(basic_processing.decisions_path(name)),
+                profiling.profile_path(name),
+            ]
+            cache.store(keys[name], f"process {name}", outputs, results[name])
+    basic_processing.write_summary(results)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="number of worker processes (default: number of cores)",
+    )
+    parser.add_argument(
+        "--skip-parsing",
+        action="store_true",
+        help="reuse the existing parsed exports in outputs/database-search-results",
+    )
+    parser.add_argument(
+        "--skip-merge",
+        action="store_true",
+        help="stop before merging the processed sources",
+    )
+    parser.add_argument(
+        "--format",
+        choices=intermediate.FORMATS,
+        help="file format for intermediate tables (default: parquet if available)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        help="process each source this many records at a time to bound memory",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="re-run every stage without reading or writing the stage cache",
+    )
+    parser.add_argument(
+        "--record-store",
+        help="also write records and decisions to this SQLite database"
+        " (see basic_processing/record_store.py)",
+    )
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    if args.format is not None:
+        os.environ["INTERMEDIATE_FORMAT"] = args.format
+    if args.chunk_size is not None:
+        os.environ["PROCESS_CHUNK_SIZE"] = str(args.chunk_size)
+    if args.record_store is not None:
+        os.environ["RECORD_STORE"] = args.record_store
+    cache = None if args.no_cache else stage_cache.StageCache()
+    # The record store, and any profiling beyond the defaults, are written
+    # by processing and merging themselves, so they are re-run rather than
+    # restored from the cache.
+    run_cache = cache
+    if record_store.store_path() is not None or profiling.requested():
+        run_cache = None
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        if not args.skip_parsing:
+            parse_all(pool, cache)
+        process_all(pool, run_cache)
+    if not args.skip_merge:
+        merge_datasets.main(run_cache)
+
+
+if __name__ == "__main__":
+    sys.exit(main())